@@ -34,6 +34,28 @@ FILE_CACHE_CONTROL = 'private, max-age=86400'
 FILE_CACHE_TIME = datetime.timedelta(days=1)
 
 
+# Resized variants of image attachments, as name: maximum width in pixels.
+# A variant is requested by adding ?size=<name> to the attachment's URL.
+IMAGE_VARIANTS = {
+    'thumb': 100,
+    'small': 320,
+    'medium': 640,
+}
+
+# Variant URLs carry the version of the original, so they never go stale.
+IMAGE_VARIANT_CACHE_CONTROL = 'private, max-age=31536000'
+IMAGE_VARIANT_CACHE_TIME = datetime.timedelta(days=365)
+
+# Sitemaps list public content only and may be cached by shared caches.
+SITEMAP_CACHE_CONTROL = 'public, max-age=3600'
+SITEMAP_CACHE_TIME = datetime.timedelta(hours=1)
+
+
+# Set to True once the "Index the email addresses of existing users"
+# maintenance task has finished, so that users are only looked up by key.
+PROFILE_EMAILS_INDEXED = False
+
+
 # Title for the website
 SYSTEM_TITLE = 'App Engine Site Creator'
 
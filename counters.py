@@ -0,0 +1,199 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""View counts of pages and attachments.
+
+A view only increments a count in the instance's memory.  Once every
+FLUSH_INTERVAL seconds the instance hands its counts to a task, which adds
+them to the datastore.  Counts are kept per day, so that the ranking of
+popular items follows what is viewed now rather than what was viewed most
+since the site started.  The count of each item on each day is split over
+NUM_SHARDS ViewCounterShard entities and each flush writes to one shard chosen
+at random, so concurrent flushes rarely touch the same entity however popular
+the item is.
+
+Every flush carries an id, which the shards it updated remember.  A task that
+runs again after its counts were stored, as the task queue may do, finds its
+id in the shard and adds nothing.
+
+"""
+
+import logging
+import random
+import time
+
+from google.appengine.ext import db
+import utility
+
+# Seconds between flushes of an instance's counts.
+FLUSH_INTERVAL = 60
+
+# Number of entities the count of each item on each day is split over.
+NUM_SHARDS = 8
+
+# Largest number of shards written in one transaction; a cross group
+# transaction may touch at most 25 entity groups.
+SHARDS_PER_TRANSACTION = 24
+
+# Number of flush ids remembered by each shard.  A task retried after more
+# flushes than this have reached the same shard would be counted twice.
+RECENT_FLUSHES = 50
+
+# Seconds in one period of the counts.
+DAY = 24 * 60 * 60
+
+# Number of days, including today, whose views rank the popular items.
+POPULAR_DAYS = 7
+
+# Seconds the list of popular items is cached for.
+POPULAR_CACHE_TIME = 600
+
+# Views counted by this instance since the last flush, keyed by (kind, id).
+_pending = {}
+
+# Time of the last flush.
+_last_flush = time.time()
+
+
+class ViewCounterShard(db.Model):
+  """Part of the view count of a page or an attachment on one day."""
+
+  kind = db.StringProperty(required=True)
+  item_id = db.IntegerProperty(required=True)
+  day = db.IntegerProperty()
+  count = db.IntegerProperty(default=0)
+  flush_ids = db.StringListProperty(indexed=False)
+
+  @staticmethod
+  def key_for(kind, item_id, day, shard):
+    """Returns the key of one shard of the count of an item on a day."""
+    return db.Key.from_path('ViewCounterShard',
+                            '%s:%d:%d:%d' % (kind, item_id, day, shard))
+
+
+def today():
+  """Returns the number of the current day."""
+  return int(time.time() / DAY)
+
+
+def record_view(kind, item_id):
+  """Counts a view of an item, flushing the instance's counts when due.
+
+  Args:
+    kind: kind of the item, such as models.ACTIVITY_PAGE
+    item_id: id of the item
+
+  """
+  key = (kind, item_id)
+  _pending[key] = _pending.get(key, 0) + 1
+  if time.time() - _last_flush >= FLUSH_INTERVAL:
+    flush()
+
+
+def flush():
+  """Hands the instance's counts to a task that stores them."""
+  global _pending, _last_flush  # pylint: disable-msg=W0603
+  from google.appengine.api import taskqueue  # pylint: disable-msg=W0404
+
+  pending = _pending
+  _pending = {}
+  _last_flush = time.time()
+  if not pending:
+    return
+
+  counts = ' '.join(['%s:%d:%d' % (kind, item_id, count)
+                     for (kind, item_id), count in pending.items()])
+  flush_id = '%d-%d' % (int(_last_flush * 1000), random.getrandbits(32))
+  try:
+    taskqueue.add(name='view-counts-%s' % flush_id,
+                  url=utility.task_url('store_view_counts'),
+                  params={'counts': counts, 'flush_id': flush_id,
+                          'day': today(),
+                          'shard': random.randrange(NUM_SHARDS)})
+  except taskqueue.Error, err:
+    logging.warning('Could not queue view counts: %s', err)
+    for key, count in pending.items():
+      _pending[key] = _pending.get(key, 0) + count
+
+
+def store_counts(counts, flush_id, day, shard):
+  """Adds counts handed over by flush to one shard per item.
+
+  Args:
+    counts: the text built by flush, 'kind:id:count' separated by spaces
+    flush_id: the id of the flush, used to store its counts only once
+    day: the number of the day the views were counted on
+    shard: the number of the shard to add the counts to
+
+  """
+  increments = {}
+  for item in counts.split():
+    kind, item_id, count = item.split(':')
+    increments[ViewCounterShard.key_for(kind, int(item_id), day, shard)] = (
+        kind, int(item_id), int(count))
+  keys = increments.keys()
+
+  def txn(batch):
+    """Adds the counts of one batch of shards."""
+    shards = []
+    for key, counter in zip(batch, db.get(batch)):
+      kind, item_id, count = increments[key]
+      if counter is None:
+        counter = ViewCounterShard(key=key, kind=kind, item_id=item_id,
+                                   day=day)
+      elif flush_id in counter.flush_ids:
+        continue
+      counter.count += count
+      counter.flush_ids = (counter.flush_ids + [flush_id])[-RECENT_FLUSHES:]
+      shards.append(counter)
+    db.put(shards)
+
+  options = db.create_transaction_options(xg=True)
+  for start in range(0, len(keys), SHARDS_PER_TRANSACTION):
+    db.run_in_transaction_options(options, txn,
+                                  keys[start:start + SHARDS_PER_TRANSACTION])
+
+
+def popular(kind, limit):
+  """Returns the ids of the items of a kind most viewed in recent days.
+
+  Only the views of the last POPULAR_DAYS days count.  The ranking is read
+  from the largest shards, so items whose views are spread thinly over many
+  shards may be ranked a little low.
+
+  Args:
+    kind: kind of the items, such as models.ACTIVITY_PAGE
+    limit: maximum number of ids to return
+
+  Returns:
+    A list of item ids
+
+  """
+  key = 'popular:%s:%d' % (kind, limit)
+  item_ids = utility.memcache_get(key)
+  if item_ids is None:
+    first_day = today() - POPULAR_DAYS + 1
+    days = range(first_day, first_day + POPULAR_DAYS)
+    query = ViewCounterShard.all().filter('kind =', kind)
+    query.filter('day IN', days).order('-count')
+    totals = {}
+    for counter in query.fetch(limit * NUM_SHARDS * POPULAR_DAYS):
+      totals[counter.item_id] = totals.get(counter.item_id, 0) + counter.count
+    ranked = sorted(totals.items(), key=lambda item: -item[1])
+    item_ids = [item_id for item_id, _ in ranked[:limit]]
+    utility.memcache_set(key, item_ids, POPULAR_CACHE_TIME)
+  return item_ids
@@ -0,0 +1,82 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Measures page render time with and without the compiled-template cache.
+
+Usage: render_benchmark.py [--sdk /path/to/google_appengine] [--renders N]
+
+"""
+
+import optparse
+import time
+
+import startup_benchmark
+
+# Template loaders to compare; the first one parses on every request.
+LOADERS = (
+    ('filesystem', 'django.template.loaders.filesystem.Loader'),
+    ('cached', 'template_loader.Loader'),
+)
+
+
+def render_pages(renders):
+  """Renders the theme's page template repeatedly.
+
+  Args:
+    renders: number of times to render the page
+
+  Returns:
+    Average milliseconds per render
+
+  """
+  from django.template import loader
+  import configuration
+
+  template_name = 'themes/%s/page.html' % configuration.SYSTEM_THEME_NAME
+  params = {'page': {'title': 'Benchmark', 'content': '<p>Hello</p>' * 200,
+                     'breadcrumbs': [{'path': '/', 'name': 'Home'}]},
+            'files': [], 'is_editor': False, 'sidebar': '<ul></ul>',
+            'configuration': configuration}
+
+  start = time.time()
+  for _ in range(renders):
+    loader.render_to_string(template_name, params)
+  return (time.time() - start) * 1000 / renders
+
+
+def main():
+  """Prints the average render time for each template loader."""
+  parser = optparse.OptionParser()
+  parser.add_option('--sdk', default='/usr/local/google_appengine',
+                    help='path to the App Engine SDK')
+  parser.add_option('--renders', type='int', default=200,
+                    help='number of renders to average over')
+  options = parser.parse_args()[0]
+
+  startup_benchmark.set_up_paths(options.sdk)
+  import appengine_config  # pylint: disable-msg=W0612
+  from django.conf import settings
+  from django.template import loader
+
+  for name, template_loader in LOADERS:
+    settings.TEMPLATE_LOADERS = (template_loader,)
+    loader.template_source_loaders = None
+    print '%-10s %8.2f ms per render' % (name, render_pages(options.renders))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,194 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Measures the cold start cost of the application's import paths.
+
+Each import path is measured in a fresh interpreter so that nothing is shared
+between runs.  The time and the peak resident memory of the child process are
+reported, which makes it easy to see when an admin-only module leaks into the
+public serving path.  The public path also serves the home page to an
+anonymous visitor, so that the modules loaded while resolving and reversing
+URLs are counted as well.
+
+Usage: startup_benchmark.py [--sdk /path/to/google_appengine] [--runs N]
+
+"""
+
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+APP_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import paths to measure, cheapest first, as (name, modules, whether the
+# home page is served after the imports).
+IMPORT_PATHS = (
+    ('public', ['main', 'middleware', 'views.main'], True),
+    ('public+admin', ['main', 'middleware', 'views.main', 'views.admin',
+                      'forms'], False),
+)
+
+# Modules that must not be loaded by the public path.
+ADMIN_ONLY_MODULES = ('views.admin', 'views.tasks', 'forms',
+                      'google.appengine.ext.db.djangoforms', 'django.forms')
+
+
+def set_up_paths(sdk_path):
+  """Makes the SDK and the application importable.
+
+  Args:
+    sdk_path: root directory of the App Engine SDK
+
+  """
+  sys.path.insert(0, '%s/lib/django/' % sdk_path)
+  sys.path.insert(0, '%s/lib/webob/' % sdk_path)
+  sys.path.insert(0, '%s/lib/yaml/lib/' % sdk_path)
+  sys.path.insert(0, sdk_path)
+  sys.path.insert(0, APP_ROOT)
+  os.environ.setdefault('SERVER_SOFTWARE', 'Development/benchmark')
+  os.environ.setdefault('APPLICATION_ID', 'aesc')
+  os.environ.setdefault('CURRENT_VERSION_ID', 'benchmark')
+
+
+def render_public_page():
+  """Serves the home page to an anonymous visitor through Django.
+
+  The home page is stored with db.put rather than Model.put, whose hooks
+  queue tasks outside of any request and so reverse with the full urlconf.
+
+  Returns:
+    The status line of the response
+  """
+  import StringIO
+  import django.core.handlers.wsgi
+  from google.appengine.ext import db
+  import models
+  import upload_rpcs
+
+  upload_rpcs.set_up_stubs()
+  os.environ['USER_EMAIL'] = ''
+  acl = models.AccessControlList(global_read=True)
+  db.put(acl)
+  db.put(models.Page(name='Home', title='Home', content='<p>Welcome</p>',
+                     acl=acl))
+
+  environ = {
+      'REQUEST_METHOD': 'GET',
+      'PATH_INFO': '/',
+      'SERVER_NAME': 'localhost',
+      'SERVER_PORT': '80',
+      'HTTP_HOST': 'localhost',
+      'wsgi.input': StringIO.StringIO(''),
+      'wsgi.errors': sys.stderr,
+      'wsgi.url_scheme': 'http',
+  }
+  status = []
+
+  def start_response(status_line, unused_headers, unused_exc_info=None):
+    """Records the status of the response."""
+    status.append(status_line)
+
+  ''.join(django.core.handlers.wsgi.WSGIHandler()(environ, start_response))
+  return status[0]
+
+
+def measure_child(sdk_path, modules, render):
+  """Imports modules and prints the elapsed time and loaded admin modules.
+
+  Args:
+    sdk_path: root directory of the App Engine SDK
+    modules: list of module names to import, in order
+    render: whether to serve the home page after the imports
+
+  """
+  set_up_paths(sdk_path)
+  start = time.time()
+  for module in modules:
+    __import__(module)
+  if render:
+    status = render_public_page()
+    if not status.startswith('200'):
+      sys.exit('The home page could not be served: %s' % status)
+  elapsed = (time.time() - start) * 1000
+  leaked = [name for name in ADMIN_ONLY_MODULES if name in sys.modules]
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  print '%f %d %s' % (elapsed, usage.ru_maxrss, ','.join(leaked))
+
+
+def measure(sdk_path, modules, render):
+  """Runs a child interpreter to measure one import path.
+
+  Args:
+    sdk_path: root directory of the App Engine SDK
+    modules: list of module names to import, in order
+    render: whether to serve the home page after the imports
+
+  Returns:
+    A tuple of (milliseconds, peak memory in KB, list of admin modules loaded)
+
+  """
+  command = [sys.executable, os.path.abspath(__file__), '--sdk', sdk_path,
+             '--child', ','.join(modules)]
+  if render:
+    command.append('--render')
+  child = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=APP_ROOT)
+  output = child.communicate()[0]
+  if child.returncode:
+    raise RuntimeError('Measuring %s failed' % ', '.join(modules))
+  elapsed, memory, leaked = (output.strip().splitlines()[-1].split(' ') +
+                             [''])[:3]
+  return float(elapsed), int(memory), [name for name in leaked.split(',')
+                                       if name]
+
+
+def main():
+  """Measures every import path and prints a report."""
+  parser = optparse.OptionParser()
+  parser.add_option('--sdk', default='/usr/local/google_appengine',
+                    help='path to the App Engine SDK')
+  parser.add_option('--runs', type='int', default=5,
+                    help='number of cold starts to average over')
+  parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+  parser.add_option('--render', action='store_true',
+                    help=optparse.SUPPRESS_HELP)
+  options = parser.parse_args()[0]
+
+  if options.child:
+    measure_child(options.sdk, options.child.split(','), options.render)
+    return
+
+  failed = False
+  for name, modules, render in IMPORT_PATHS:
+    results = [measure(options.sdk, modules, render)
+               for _ in range(options.runs)]
+    times = [result[0] for result in results]
+    memory = max([result[1] for result in results])
+    print '%-14s %8.1f ms (min %.1f)  peak %6d KB' % (
+        name, sum(times) / len(times), min(times), memory)
+    if name == 'public' and results[0][2]:
+      print '  admin modules loaded by the public path: %s' % (
+          ', '.join(results[0][2]))
+      failed = True
+
+  sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+  main()
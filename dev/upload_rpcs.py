@@ -0,0 +1,134 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Checks the number of API calls made to create and replace an attachment.
+
+The calls are counted against in-memory datastore and memcache stubs.  The
+script exits with a non-zero status if an upload makes more calls than
+expected.
+
+Usage: upload_rpcs.py [--sdk /path/to/google_appengine]
+
+"""
+
+import optparse
+import sys
+
+import startup_benchmark
+from startup_benchmark import APP_ROOT
+
+# Maximum number of calls per upload: a transaction begin, one batch get,
+# one batch put and a commit in the datastore, the put of the activity record,
+# the task that updates the sitemap, then one memcache delete of the parent's
+# attachment lists and one memcache increment of the parent page's version
+# and of the missing path generation.
+MAX_UPLOAD_CALLS = 8
+
+# Replacing data may also delete the resized variants of the old data.
+MAX_REPLACE_CALLS = MAX_UPLOAD_CALLS + 2
+
+
+def set_up_stubs():
+  """Registers in-memory stubs for the APIs used by the models.
+
+  Returns:
+    A list that records the (service, call) of every API call made
+
+  """
+  from google.appengine.api import apiproxy_stub_map
+  from google.appengine.api.memcache import memcache_stub
+  from google.appengine.api.taskqueue import taskqueue_stub
+  from google.appengine.datastore import datastore_stub_util
+  from google.appengine.api import datastore_file_stub
+
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+  datastore = datastore_file_stub.DatastoreFileStub(
+      'dev~aesc', None, None, consistency_policy=policy)
+  apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore)
+  apiproxy_stub_map.apiproxy.RegisterStub(
+      'memcache', memcache_stub.MemcacheServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub(
+      'taskqueue', taskqueue_stub.TaskQueueServiceStub(root_path=APP_ROOT))
+
+  calls = []
+
+  def record_call(service, call, *_):
+    """Records an API call."""
+    calls.append((service, call))
+
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+      'count_calls', record_call)
+  return calls
+
+
+def count_calls(calls, func):
+  """Runs func and returns the API calls it made."""
+  del calls[:]
+  func()
+  return list(calls)
+
+
+def report(name, made, limit):
+  """Prints the calls made by an operation.
+
+  Returns:
+    True if no more than limit calls were made
+
+  """
+  print '%s: %d calls (limit %d)' % (name, len(made), limit)
+  for service, call in made:
+    print '  %s.%s' % (service, call)
+  return len(made) <= limit
+
+
+def main():
+  """Uploads and replaces an attachment and checks the calls made."""
+  parser = optparse.OptionParser()
+  parser.add_option('--sdk', default='/usr/local/google_appengine',
+                    help='path to the App Engine SDK')
+  options = parser.parse_args()[0]
+
+  startup_benchmark.set_up_paths(options.sdk)
+  calls = set_up_stubs()
+  import appengine_config  # pylint: disable-msg=W0612
+  from google.appengine.ext import db
+  import models
+  import utility
+
+  root = utility.set_up_data_store()
+  file_record = models.FileStore(name='logo.png', parent_page=root)
+
+  def upload():
+    """Creates the attachment the way views.admin.upload_file does."""
+    file_record.data = db.Blob('x' * 4096)
+    file_record.is_hidden = False
+    file_record.put()
+
+  def replace():
+    """Replaces the attachment's data."""
+    file_record.data = db.Blob('y' * 4096)
+    file_record.put()
+
+  passed = report('upload', count_calls(calls, upload), MAX_UPLOAD_CALLS)
+  passed = report('replace', count_calls(calls, replace),
+                  MAX_REPLACE_CALLS) and passed
+  sys.exit(not passed and 1 or 0)
+
+
+if __name__ == '__main__':
+  main()
@@ -17,8 +17,13 @@
 
 """Forms referenced by the views."""
 
+import django
 from django import forms
 from django.utils import translation
+
+# Work-around to avoid warning about django.newforms in djangoforms.
+django.newforms = forms
+
 from google.appengine.ext.db import djangoforms
 import models
 import validators
@@ -65,6 +70,23 @@ class GroupEditForm(djangoforms.ModelForm):
     model = models.UserGroup
     exclude = ['users']
 
+  def clean_name(self):
+    """Checks that no other group has the name.
+
+    UserGroup.put makes the same check in a transaction; checking here lets
+    the form show the error.
+
+    Returns:
+      The name
+    """
+    name = self.cleaned_data['name']
+    group = models.UserGroup.get_by_name(name)
+    if group and (self.instance is None or
+                  group.key() != self.instance.key()):
+      raise forms.ValidationError(
+          translation.ugettext('There is already a group with this name.'))
+    return name
+
 
 class UserEditForm(djangoforms.ModelForm):
   """Form used by editors to modify a user profile."""
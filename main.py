@@ -27,6 +27,10 @@ directly -- everything else is controlled from there.
 import os
 import sys
 import logging
+import time
+
+# Used to report how long the instance took to import the serving path.
+_IMPORT_START = time.time()
 
 # Log a message each time this module get loaded.
 logging.info('Loading %s, app version = %s',
@@ -40,14 +44,12 @@ from google.appengine.ext.webapp import util
 # Import webapp.template.  This makes most Django setup issues go away.
 from google.appengine.ext.webapp import template  # pylint: disable-msg=W0611
 
-# Import various parts of Django.
+# Import various parts of Django.  Only what is needed to serve public pages
+# is imported here; the admin views pull in django.forms and djangoforms
+# through the forms module the first time they are used.
 import django.core.handlers.wsgi
 import django.core.signals
 import django.db
-import django.forms
-
-# Work-around to avoid warning about django.newforms in djangoforms.
-django.newforms = django.forms
 
 
 def log_exception(*args, **kwds):
@@ -64,6 +66,21 @@ django.core.signals.got_request_exception.connect(log_exception)
 django.core.signals.got_request_exception.disconnect(
     django.db._rollback_on_exception)  # pylint: disable-msg=W0212
 
+def log_startup_cost():
+  """Logs the time and memory spent importing the serving path."""
+  elapsed = (time.time() - _IMPORT_START) * 1000
+  try:
+    from google.appengine.api import runtime  # pylint: disable-msg=E0611
+    memory = '%.1f MB' % runtime.memory_usage().current()
+  except (ImportError, AttributeError):
+    memory = 'unknown'
+  logging.info('Cold start imports took %.0f ms, memory usage %s',
+               elapsed, memory)
+
+
+log_startup_cost()
+
+
 def main():
   """Loads the django application."""
   application = django.core.handlers.wsgi.WSGIHandler()
@@ -25,6 +25,9 @@ from google.appengine.api import users
 import models
 import utility
 
+# Paths that are resolved with the full urlconf even for anonymous visitors.
+PRIVATE_PATH_PREFIXES = ('/admin/', '/_tasks/', '/_ah/', '/_treedata/')
+
 
 class AddUserToRequestMiddleware(object):
   # pylint: disable-msg=R0903
@@ -34,6 +37,13 @@ class AddUserToRequestMiddleware(object):
   request.  If the user is an administrator of the application but does
   not have a profile, one is created.
 
+  The middleware also bounds the request memo of utility.memcache_get, so
+  that the profile, the user's groups and the ACL decisions are only read
+  from the memcache once per request.
+
+  Requests from visitors who are not signed in are resolved with
+  public_urls, which keeps the admin and task views out of the instance.
+
   """
 
   def process_request(self, request):
@@ -46,6 +56,7 @@ class AddUserToRequestMiddleware(object):
     Returns:
       None
     """
+    utility.start_request_memo()
     user = users.GetCurrentUser()
     request.user = user
     request.profile = None
@@ -60,5 +71,21 @@ class AddUserToRequestMiddleware(object):
           logging.info('Created profile for admin %s' % profile.email)
 
       request.profile = profile
+    elif not request.path.startswith(PRIVATE_PATH_PREFIXES):
+      request.urlconf = 'public_urls'
 
     return None
+
+  def process_response(self, request, response):
+    # pylint: disable-msg=R0201,W0613
+    """Method defined by Django to handle processing responses.
+
+    Args:
+      request: the http request that was processed
+      response: the http response to return
+
+    Returns:
+      The response, unchanged
+    """
+    utility.end_request_memo()
+    return response
@@ -17,15 +17,170 @@
 
 """Datastore models."""
 
+import difflib
+import hashlib
+import logging
+import mimetypes
+import zlib
+
+import configuration
 from django.core import urlresolvers
-from django.core import validators
 from django.utils import encoding
+from django.utils import simplejson
+from google.appengine.api import users
 from google.appengine.ext import db
 
 import utility
 import yaml
 
 
+# Kinds of object whose changes are recorded in the activity feed.
+ACTIVITY_PAGE = 'page'
+ACTIVITY_FILE = 'file'
+ACTIVITY_ACL = 'acl'
+ACTIVITY_SIDEBAR = 'sidebar'
+ACTIVITY_KINDS = (ACTIVITY_PAGE, ACTIVITY_FILE, ACTIVITY_ACL,
+                  ACTIVITY_SIDEBAR)
+
+# Changes recorded in the activity feed.
+ACTIVITY_CREATED = 'created'
+ACTIVITY_UPDATED = 'updated'
+ACTIVITY_DELETED = 'deleted'
+ACTIVITY_ACTIONS = (ACTIVITY_CREATED, ACTIVITY_UPDATED, ACTIVITY_DELETED)
+
+# Seconds for which a path that matched nothing is remembered.
+MISSING_PATH_CACHE_TIME = 60
+
+# Memcache counter incremented whenever a page or file is saved or deleted.
+# A path is remembered as missing together with the value of the counter,
+# and the entry only counts while the counter is unchanged, since the saved
+# page or file may have been created or moved to that path or to one of its
+# parents.
+MISSING_PATH_GENERATION_KEY = 'missing-path-generation'
+
+# Memcache key of the version of the sidebar, incremented when it is saved.
+SIDEBAR_VERSION_KEY = 'sidebar-version'
+
+
+class Activity(db.Model):
+  """Records one change to a page, an attachment, an ACL or the sidebar.
+
+  Only the timestamp is indexed, so each record costs a single index write
+  and the feed is read newest first with one cursor-paginated query.
+
+  """
+
+  kind = db.StringProperty(choices=ACTIVITY_KINDS, indexed=False)
+  action = db.StringProperty(choices=ACTIVITY_ACTIONS, indexed=False)
+  target_id = db.IntegerProperty(indexed=False)
+  parent_id = db.IntegerProperty(indexed=False)
+  name = db.StringProperty(indexed=False)
+  actor = db.StringProperty(indexed=False)
+  timestamp = db.DateTimeProperty(auto_now_add=True)
+
+  @staticmethod
+  def record(kind, action, target_id=None, parent_id=None, name=None):
+    """Records a change made by the current user.
+
+    Args:
+      kind: kind of the changed object, one of ACTIVITY_KINDS
+      action: the change, one of ACTIVITY_ACTIONS
+      target_id: id of the changed page or file, or of the page whose ACL
+                 changed
+      parent_id: id of the page a changed file is attached to
+      name: name of the changed object at the time of the change
+
+    """
+    user = users.get_current_user()
+    Activity(kind=kind, action=action, target_id=target_id,
+             parent_id=parent_id, name=name,
+             actor=user and user.email() or None).put()
+
+  @staticmethod
+  def feed(limit, since=None, cursor=None):
+    """Returns one page of changes, newest first.
+
+    Args:
+      limit: maximum number of changes to return
+      since: optional datetime; only later changes are returned
+      cursor: cursor returned with the previous page, if any
+
+    Returns:
+      A tuple of (list of Activity, cursor for the next page or None)
+
+    """
+    query = Activity.all().order('-timestamp')
+    if since:
+      query.filter('timestamp >', since)
+    if cursor:
+      query.with_cursor(cursor)
+    activities = query.fetch(limit)
+    if len(activities) < limit:
+      return activities, None
+    return activities, query.cursor()
+
+
+# Largest number of compiled ACLs kept by an instance.
+MAX_COMPILED_ACLS = 1000
+
+# Compiled ACLs, keyed by the id and version of the ACL.
+_compiled_acls = {}
+
+
+class CompiledAcl(object):
+  """An immutable copy of an AccessControlList for fast permission checks.
+
+  The users and groups are kept in frozensets, and the users and groups that
+  can write are included in those that can read, so that each check is one
+  set lookup and at most one intersection with the groups of the user.
+
+  """
+
+  def __init__(self, acl):
+    """Compiles an ACL.
+
+    Args:
+      acl: the AccessControlList to compile
+
+    """
+    self.global_write = bool(acl.global_write)
+    self.global_read = self.global_write or bool(acl.global_read)
+    self.write_users = frozenset(acl.user_write)
+    self.write_groups = frozenset([key.id() for key in acl.group_write])
+    self.read_users = self.write_users | frozenset(acl.user_read)
+    self.read_groups = self.write_groups | frozenset(
+        [key.id() for key in acl.group_read])
+
+  @staticmethod
+  def allows(user, user_keys, group_ids):
+    """Determines if a user is a superuser or is among users or groups.
+
+    Args:
+      user: UserProfile to check, or None for an anonymous user
+      user_keys: set of the keys of the allowed users
+      group_ids: set of the ids of the allowed groups
+
+    Returns:
+      True if the user is allowed, False otherwise
+
+    """
+    if user is None:
+      return False
+    if user.is_superuser or user.key() in user_keys:
+      return True
+    return bool(group_ids and user.group_ids & group_ids)
+
+  def can_write(self, user):
+    """Determines if user has write access."""
+    return self.global_write or CompiledAcl.allows(user, self.write_users,
+                                                   self.write_groups)
+
+  def can_read(self, user):
+    """Determines if user has read access."""
+    return self.global_read or CompiledAcl.allows(user, self.read_users,
+                                                  self.read_groups)
+
+
 class AccessControlList(db.Model):
   # pylint: disable-msg=R0904
   """Model defining access to objects in the system."""
@@ -35,6 +190,7 @@ class AccessControlList(db.Model):
   group_read = db.ListProperty(db.Key)
   user_read = db.ListProperty(db.Key)
   global_read = db.BooleanProperty()
+  version = db.IntegerProperty(default=0)
 
   def clone(self):
     """Returns a duplicate copy of the ACL.
@@ -53,51 +209,75 @@ class AccessControlList(db.Model):
     return new_acl
 
   def put(self):
-    """Saves the ACL and flushes the memcache."""
-    super(AccessControlList, self).put()
+    """Saves the ACL, queues a sitemap rebuild and flushes the memcache.
+
+    Which pages are public may have changed anywhere below the pages using
+    the ACL, so the whole sitemap is rebuilt.
+
+    The version is incremented from the stored entity in a transaction, so
+    concurrent saves never share a version and every instance compiles each
+    saved content under its own version.
+
+    """
+
+    def txn():
+      """Increments the stored version and saves the ACL."""
+      stored = None
+      if self.is_saved():
+        stored = AccessControlList.get(self.key())
+      self.version = (stored and stored.version or 0) + 1
+      super(AccessControlList, self).put()
+
+    db.run_in_transaction(txn)
+    utility.add_unique_task(
+        'sitemap-all', utility.task_url('rebuild_sitemap'))
     utility.clear_memcache()
 
-  def __has_access(self, user, access_type):
-    """Determines if user has the specified access type.
+  def compile(self):
+    """Returns the CompiledAcl of the ACL.
 
-    Args:
-      user: UserProfile to check
-      access_type: Type of access to check, either 'read' or 'write'
+    The compiled form of a saved ACL is shared by every check made in the
+    instance until the ACL is saved again.
 
     Returns:
-      True if the user has the requested access, False otherwise
+      A CompiledAcl
 
     """
-    if user is not None:
-      key = 'acl-has-%s:%s-%s' % (access_type, self.key().id(), user.key().id())
-    else:
-      key = 'acl-has-%s:%s' % (access_type, self.key().id())
-    has_access = utility.memcache_get(key)
+    if not self.is_saved():
+      return CompiledAcl(self)
+    key = (self.key().id(), self.version)
+    compiled = _compiled_acls.get(key)
+    if compiled is None:
+      if len(_compiled_acls) >= MAX_COMPILED_ACLS:
+        _compiled_acls.clear()
+      compiled = _compiled_acls[key] = CompiledAcl(self)
+    return compiled
 
-    if has_access is not None:
-      return has_access
+  @staticmethod
+  def can_read_any(items, user):
+    """Determines if a user can read at least one of several pages or files.
 
-    global_access = self.__getattribute__('global_%s' % access_type)
-    user_list = self.__getattribute__('user_%s' % access_type)
-    group_list = self.__getattribute__('group_%s' % access_type)
-    
-    if global_access:
-      has_access = True
-        
-    if user is not None:
-      if user.is_superuser or user.key() in user_list:
-        has_access = True
-      else:
-        for group in UserGroup.get(group_list):
-          if user.key() in group.users:
-            has_access = True
-            break
+    The distinct ACLs of the items are merged first, so the check costs one
+    set lookup and one intersection however many items there are.
 
-    if has_access is None:
-      has_access = False
+    Args:
+      items: list of Page or FileStore objects
+      user: UserProfile to check
 
-    utility.memcache_set(key, has_access)
-    return has_access
+    Returns:
+      True if the user can read any of the items, False otherwise
+
+    """
+    read_users = set()
+    read_groups = set()
+    for compiled in set([item.acl.compile() for item in items]):
+      if compiled.global_read:
+        return True
+      read_users |= compiled.read_users
+      read_groups |= compiled.read_groups
+    if not items:
+      return False
+    return CompiledAcl.allows(user, read_users, read_groups)
 
   def user_can_write(self, user):
     """Determines if user has write access.
@@ -109,7 +289,7 @@ class AccessControlList(db.Model):
       True if the user has write access, False otherwise
 
     """
-    return self.__has_access(user, 'write')
+    return self.compile().can_write(user)
 
   def user_can_read(self, user):
     """Determines if user has read access.
@@ -121,10 +301,7 @@ class AccessControlList(db.Model):
       True if the user has read access, False otherwise
 
     """
-    if self.user_can_write(user):
-      return True
-
-    return self.__has_access(user, 'read')
+    return self.compile().can_read(user)
 
 
 class File(db.Model):
@@ -136,24 +313,172 @@ class File(db.Model):
   parent_page = db.SelfReferenceProperty()
   acl_data = db.ReferenceProperty(AccessControlList)
 
-  def put(self):
-    """Overridden method to flush the memcache."""
-    if self.acl_data:
-      self.acl_data.put()
+  # Kind of the file in the activity feed; None if changes are not recorded.
+  activity_kind = None
+
+  def put(self, previous=None):
+    """Overridden method to record the change and to flush the memcache.
+
+    The ACL is not saved here: a reference can only be made to an ACL that
+    has already been saved, and changes to it are saved by AccessControlList.
+
+    Args:
+      previous: the stored copy of the file, if the caller has loaded it
+
+    """
+    created = not self.is_saved()
+    content_only = self.is_content_only_change(previous)
     super(File, self).put()
-    utility.clear_memcache()
+    self.record_change(created and ACTIVITY_CREATED or ACTIVITY_UPDATED)
+    if content_only:
+      self.refresh_cache()
+    else:
+      self.invalidate_cache()
 
   def delete(self):
-    """Overridden method to clean up ACLs and to flush the memcache."""
+    """Overridden method to clean up ACLs, record the change and flush."""
     if self.acl_data:
       self.acl_data.delete()
     super(File, self).delete()
+    self.record_change(ACTIVITY_DELETED)
+    self.invalidate_cache()
+
+  def record_change(self, action):
+    """Records a change to the file and queues the updates that depend on it.
+
+    The change is added to the activity feed, and a task is queued to bring
+    the search index and the sitemap up to date.
+
+    Args:
+      action: the change, one of ACTIVITY_ACTIONS
+
+    """
+    if not self.activity_kind:
+      return
+    parent_key = File.parent_page.get_value_for_datastore(self)
+    Activity.record(self.activity_kind, action, self.key().id(),
+                    parent_key and parent_key.id(), self.name)
+
+    from google.appengine.api import taskqueue  # pylint: disable-msg=W0404
+    if self.activity_kind == ACTIVITY_PAGE:
+      params = {'page_id': self.key().id(), 'search': 1}
+    else:
+      params = {'page_id': parent_key.id()}
+    taskqueue.add(url=utility.task_url('page_changed'),
+                  params=params)
+
+  def is_content_only_change(self, previous):
+    """Returns True if saving the file leaves its path and ACL unchanged.
+
+    Such a change only requires refresh_cache rather than a memcache flush.
+
+    Args:
+      previous: the stored copy of the file, or None if it is not known
+
+    """
+    return False
+
+  def invalidate_cache(self):
+    """Removes cached data that depends on the file from the memcache.
+
+    Flushing the memcache also forgets every path remembered as missing.
+    Overrides that keep the memcache must increment
+    MISSING_PATH_GENERATION_KEY instead.
+
+    """
     utility.clear_memcache()
 
+  def refresh_cache(self):
+    """Updates cached data after a change that is_content_only_change."""
+    self.invalidate_cache()
+
+  @staticmethod
+  def get_by_path(path_str):
+    """Finds the page or attachment at a URL path, through memcache.
+
+    The item cached for the full path and the record of the path being
+    missing are read with one memcache call, so a repeated request for a path
+    that does not exist costs a single lookup.  When the full path is not
+    cached, one request resolves it while concurrent requests wait briefly
+    for the result.
+
+    Attachments are cached by key rather than whole, as their data may be
+    large; a cached key is only used while the attachment still has the
+    requested name.
+
+    Args:
+      path_str: the URL path, without the leading slash
+
+    Returns:
+      The Page or FileStore at the path, or None if there is none
+
+    """
+
+    def follow_url_forwards(base, path):
+      """Follow the path forwards, returning the desired item."""
+      if not base:
+        return None
+      if not path:
+        utility.memcache_set(path_key, base)
+        return base
+      if len(path) == 1:
+        attachment = base.get_attachment(path[0])
+        if attachment:
+          utility.memcache_set(path_key, attachment.key())
+          return attachment
+      return follow_url_forwards(base.get_child(path[0]), path[1:])
+
+    def follow_url_backwards(pre_path, post_path):
+      """Traverse the path backwards to find a cached page or the root."""
+      key = 'path:' + '/'.join(pre_path)
+      item = utility.memcache_get(key)
+      if isinstance(item, Page):
+        return follow_url_forwards(item, post_path)
+      if not pre_path:
+        return follow_url_forwards(Page.get_root(), post_path)
+      return follow_url_backwards(pre_path[:-1], [pre_path[-1]] + post_path)
+
+    path = [dir_name for dir_name in path_str.split('/') if dir_name]
+    path_key = 'path:' + '/'.join(path)
+    missing_key = 'missing:' + '/'.join(path)
+
+    def load_cached(value):
+      """Returns the item a cached value stands for, or None if it is stale."""
+      if not isinstance(value, db.Key):
+        return value
+      attachment = FileStore.get(value)
+      if attachment and path and attachment.name == path[-1]:
+        return attachment
+      return None
+
+    cached = utility.memcache_get_multi(
+        [path_key, missing_key, MISSING_PATH_GENERATION_KEY])
+    item = load_cached(cached.get(path_key))
+    if item:
+      return item
+    generation = cached.get(MISSING_PATH_GENERATION_KEY, 0)
+    if missing_key in cached and cached[missing_key] == generation:
+      return None
+    leased = utility.acquire_lease(path_key)
+    if not leased:
+      item = load_cached(utility.wait_for_lease(path_key))
+      if item:
+        return item
+
+    if path:
+      item = follow_url_backwards(path[:-1], path[-1:])
+    else:
+      item = follow_url_forwards(Page.get_root(), [])
+    if item is None:
+      utility.memcache_set(missing_key, generation, MISSING_PATH_CACHE_TIME)
+    if leased:
+      utility.release_lease(path_key)
+    return item
+
   def __get_acl(self):
     """Returns the ACL for the object by recursion up the path."""
     key = 'acl:%s' % self.key().id()
-    acl = utility.memcache_get(key)
+    acl = utility.memcache_get(key, memo=True)
     if acl:
       return acl
 
@@ -163,7 +488,7 @@ class File(db.Model):
     if not acl:
       acl = self.parent_page.acl
 
-    utility.memcache_set(key, acl)
+    utility.memcache_set(key, acl, memo=True)
     return acl
 
   def __set_acl(self, data):
@@ -243,14 +568,72 @@ class Page(File):
   title = db.StringProperty()
   content = db.TextProperty()
 
+  activity_kind = ACTIVITY_PAGE
+
+  def put(self):
+    """Overridden to record a revision when the title or content changed.
+
+    The stored page is loaded first, so that a page saved before revisions
+    were kept has its previous title and content recorded too.  Renaming or
+    moving the page changes the paths of everything below it, so the whole
+    sitemap is rebuilt.
+
+    """
+    previous = None
+    if self.is_saved():
+      previous = Page.get(self.key())
+    super(Page, self).put(previous)
+    PageRevision.record(self, previous)
+    if previous is not None and (
+        previous.name != self.name or
+        Page.parent_page.get_value_for_datastore(previous) !=
+        Page.parent_page.get_value_for_datastore(self)):
+      utility.add_unique_task(
+          'sitemap-all', utility.task_url('rebuild_sitemap'))
+
   def delete(self):
     """Overridden to ensure child objects are cleaned up on delete."""
     for page in self.page_children:
       page.delete()
     for file_store in self.filestore_children:
       file_store.delete()
+    db.delete(PageRevision.all(keys_only=True).ancestor(self))
     super(Page, self).delete()
 
+  def version_key(self):
+    """Returns the memcache key of the version of the page's content."""
+    return Page.version_key_for(self.key().id())
+
+  @staticmethod
+  def version_key_for(page_id):
+    """Returns the memcache key of the version of a page's content."""
+    return 'page-version:%s' % page_id
+
+  def is_content_only_change(self, previous):
+    """Overridden to compare the name, parent and ACL with the stored page."""
+    return previous is not None and (
+        previous.name == self.name and
+        Page.parent_page.get_value_for_datastore(previous) ==
+        Page.parent_page.get_value_for_datastore(self) and
+        Page.acl_data.get_value_for_datastore(previous) ==
+        Page.acl_data.get_value_for_datastore(self))
+
+  def refresh_cache(self):
+    """Overridden to keep the memcache when only the content changed.
+
+    The cached copies of the page itself are deleted, and the rendered copies
+    are marked stale, so that they are served while a task renders them
+    again.
+
+    """
+    path = [name for name in self.path.split('/') if name]
+    keys = ['path:' + '/'.join(path)]
+    if self.is_root:
+      keys.append('rootpage')
+    utility.memcache_delete(keys)
+    utility.memcache_incr_multi([self.version_key(),
+                                 MISSING_PATH_GENERATION_KEY])
+
   def get_child(self, name):
     """Returns the child with the given name."""
     return self.page_children.filter('name =', name).get()
@@ -263,10 +646,10 @@ class Page(File):
   def get_root():
     """Returns the root page."""
     key = 'rootpage'
-    root = utility.memcache_get(key)
+    root = utility.memcache_get(key, lease=True)
     if not root:
       root = Page.all().filter('parent_page =', None).get()
-      utility.memcache_set(key, root)
+      utility.memcache_set(key, root, lease=True)
     return root
 
   @property
@@ -309,27 +692,377 @@ class Page(File):
     """
     return self.filestore_children.filter('name =', name).get()
 
-  def attached_files(self):
-    """Returns all files attached to the current page.
+  def attached_files(self, category=None):
+    """Returns the files attached to the current page.
+
+    The category is matched in memory rather than by the query, so that
+    files saved before categories were stored are included.
+
+    Args:
+      category: optional media category, one of FILE_CATEGORIES, to restrict
+                the list to
 
     Returns:
-      A query representing the list of all attached files
+      A list of the attached files, ordered by name
 
     """
-    key = 'file-list:%s' % self.key().id()
+    key = 'file-list:%s:%s' % (self.key().id(), category or 'all')
     file_list = utility.memcache_get(key)
-    if not file_list:
-      # Convert the iterator to a list for caching
-      file_list = list(self.filestore_children.order('name'))
+    if file_list is None:
+      if category:
+        file_list = [file_record for file_record in self.attached_files()
+                     if file_record.get_category() == category]
+      else:
+        # Convert the iterator to a list for caching
+        file_list = list(self.filestore_children.order('name'))
       utility.memcache_set(key, file_list)
     return file_list
 
 
+# Extensions of attachments that can be resized by the images API.
+IMAGE_EXTENSIONS = ('jpg', 'gif', 'jpeg', 'png', 'bmp', 'webp')
+
+# Media categories of attachments, as stored in FileStore.category.
+CATEGORY_IMAGE = 'image'
+CATEGORY_FLASH = 'flash'
+CATEGORY_OTHER = 'other'
+CATEGORY_LINK = 'link'
+FILE_CATEGORIES = (CATEGORY_IMAGE, CATEGORY_FLASH, CATEGORY_OTHER,
+                   CATEGORY_LINK)
+
+# Extensions belonging to each media category, other than CATEGORY_OTHER.
+CATEGORY_EXTENSIONS = {
+    CATEGORY_IMAGE: IMAGE_EXTENSIONS,
+    CATEGORY_FLASH: ('swf', 'flv'),
+}
+
+
+# Every SNAPSHOT_INTERVAL-th revision of a page stores the full content; the
+# others store the changes from the revision before.
+SNAPSHOT_INTERVAL = 10
+
+
+class PageRevision(db.Model):
+  """A saved version of the title and content of a page.
+
+  Revisions are children of their page, numbered from 0.  Revisions whose
+  number is a multiple of SNAPSHOT_INTERVAL are snapshots holding the whole
+  content; the others hold a delta against the previous revision.  Both are
+  zlib compressed, so storage grows with the size of the changes, and any
+  revision is rebuilt from at most SNAPSHOT_INTERVAL records read in one
+  batch.  A revision whose previous content could not be rebuilt is stored
+  as a snapshot whatever its number, and marked as such.
+
+  A delta is a JSON list whose items are either [start, end], copying those
+  lines of the previous revision, or a string of new lines.
+
+  """
+
+  number = db.IntegerProperty(required=True)
+  title = db.StringProperty(indexed=False)
+  data = db.BlobProperty()
+  size = db.IntegerProperty(indexed=False)
+  author = db.StringProperty(indexed=False)
+  created = db.DateTimeProperty(auto_now_add=True)
+  snapshot = db.BooleanProperty(default=False, indexed=False)
+
+  @property
+  def is_snapshot(self):
+    """Returns True if the revision holds the whole content."""
+    return self.snapshot or self.number % SNAPSHOT_INTERVAL == 0
+
+  @staticmethod
+  def key_for(page_key, number):
+    """Returns the key of a revision of a page."""
+    return db.Key.from_path('PageRevision', 'r%d' % number, parent=page_key)
+
+  @staticmethod
+  def make_delta(old_content, new_content):
+    """Returns the delta turning old_content into new_content."""
+    old_lines = old_content.splitlines(True)
+    new_lines = new_content.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    delta = []
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+      if tag == 'equal':
+        delta.append([old_start, old_end])
+      elif new_end > new_start:
+        delta.append(u''.join(new_lines[new_start:new_end]))
+    return delta
+
+  @staticmethod
+  def apply_delta(old_content, delta):
+    """Returns the content produced by applying delta to old_content."""
+    old_lines = old_content.splitlines(True)
+    parts = []
+    for item in delta:
+      if isinstance(item, list):
+        parts.extend(old_lines[item[0]:item[1]])
+      else:
+        parts.append(item)
+    return u''.join(parts)
+
+  @staticmethod
+  def get_content(page_key, number):
+    """Rebuilds the content of a revision.
+
+    Args:
+      page_key: key of the page
+      number: number of the revision
+
+    Returns:
+      A tuple of (PageRevision, content), or (None, None) if there is no such
+      revision
+
+    """
+    first = number - number % SNAPSHOT_INTERVAL
+    revisions = db.get([PageRevision.key_for(page_key, revision_number)
+                        for revision_number in range(first, number + 1)])
+    # The chain starts at the latest snapshot, which may follow a gap.
+    start = len(revisions) - 1
+    while revisions[start] is not None and not revisions[start].is_snapshot:
+      start -= 1
+    if revisions[start] is None:
+      return None, None
+    content = u''
+    for revision in revisions[start:]:
+      content = revision.apply(content)
+    return revisions[-1], content
+
+  def apply(self, previous_content):
+    """Returns the content of this revision given that of the previous one."""
+    data = zlib.decompress(self.data).decode('utf-8')
+    if self.is_snapshot:
+      return data
+    return PageRevision.apply_delta(previous_content,
+                                    simplejson.loads(data))
+
+  @staticmethod
+  def record(page, previous=None):
+    """Stores a new revision of a page if its title or content changed.
+
+    The revision number is claimed in a transaction on the page's entity
+    group, so concurrent saves cannot overwrite each other's revisions.
+
+    Args:
+      page: the saved Page
+      previous: the page as stored before it was saved, if it existed.  When
+                the page has no revision yet, previous is recorded first as
+                revision 0, with no author.
+
+    """
+    content = page.content or u''
+    user = users.get_current_user()
+
+    def txn():
+      """Finds the latest revision and stores the next one."""
+      latest = PageRevision.all().ancestor(page).order('-number').get()
+      number = 0
+      previous_content = u''
+      if latest:
+        previous_content = PageRevision.get_content(page.key(),
+                                                    latest.number)[1]
+        if latest.title == page.title and previous_content == content:
+          return
+        number = latest.number + 1
+      elif previous is not None:
+        previous_content = previous.content or u''
+        if previous.title == page.title and previous_content == content:
+          return
+        PageRevision(key=PageRevision.key_for(page.key(), 0), number=0,
+                     title=previous.title, size=len(previous_content),
+                     data=db.Blob(zlib.compress(
+                         previous_content.encode('utf-8')))).put()
+        number = 1
+
+      # Without the previous content, as when a revision of the chain is
+      # missing, the whole content is stored.
+      snapshot = previous_content is None
+      if snapshot or number % SNAPSHOT_INTERVAL == 0:
+        data = content
+      else:
+        data = simplejson.dumps(PageRevision.make_delta(previous_content,
+                                                        content))
+      PageRevision(key=PageRevision.key_for(page.key(), number), number=number,
+                   title=page.title, size=len(content),
+                   data=db.Blob(zlib.compress(data.encode('utf-8'))),
+                   author=user and user.email() or None,
+                   snapshot=snapshot).put()
+
+    db.run_in_transaction(txn)
+
+
+# Largest file data kept in memcache, leaving room for memcache overhead.
+MAX_CACHED_DATA_SIZE = 900 * 1024
+
+# Size of the pieces large files are stored in, below the entity size limit.
+CHUNK_SIZE = 512 * 1024
+
+
+class FileStoreChunk(db.Model):
+  """A piece of the data of a file too large to be stored in one entity."""
+
+  data = db.BlobProperty()
+
+
+class StagedData(object):
+  # pylint: disable-msg=R0903
+  """File data that has been received but is not yet attached to a file.
+
+  Small data is held in memory.  Uploads larger than CHUNK_SIZE are written to
+  FileStoreChunk entities as they are read, so that only one chunk is ever
+  held in memory.
+
+  """
+
+  def __init__(self, content_hash=None, size=0, data=None, chunk_keys=None):
+    """Creates the staged data; with no arguments it stands for no data."""
+    self.content_hash = content_hash
+    self.size = size
+    self.data = data
+    self.chunk_keys = chunk_keys or []
+
+  @staticmethod
+  def from_data(data):
+    """Stages data that is already in memory."""
+    return StagedData(FileStoreData.hash_data(data), len(data), data=data)
+
+  @staticmethod
+  def from_file(uploaded_file):
+    """Stages an uploaded file, storing it chunk by chunk as it is read.
+
+    Args:
+      uploaded_file: a Django UploadedFile
+
+    Returns:
+      A StagedData for the file's contents
+
+    """
+    content_hash = hashlib.sha1()
+    size = 0
+    pending = None
+    chunk_keys = []
+    for chunk in uploaded_file.chunks(CHUNK_SIZE):
+      if pending is not None:
+        chunk_keys.append(FileStoreChunk(data=db.Blob(pending)).put())
+      content_hash.update(chunk)
+      size += len(chunk)
+      pending = chunk
+
+    if pending is None:
+      return StagedData()
+    if not chunk_keys:
+      return StagedData(content_hash.hexdigest(), size, data=db.Blob(pending))
+    chunk_keys.append(FileStoreChunk(data=db.Blob(pending)).put())
+    return StagedData(content_hash.hexdigest(), size, chunk_keys=chunk_keys)
+
+  def read(self):
+    """Returns the whole staged data."""
+    if self.chunk_keys:
+      return ''.join([chunk.data for chunk in db.get(self.chunk_keys)])
+    return self.data
+
+
 class FileStoreData(db.Model):
-  """A class that holds the data for a FileStore object."""
+  """A class that holds the data for one or more FileStore objects.
+
+  Data is stored once under a key name derived from its SHA-1 hash and shared
+  by every FileStore with the same content.  ref_count tracks the number of
+  FileStore objects pointing at the data; it is deleted when the last one
+  lets go of it.  Entities written before content addressing have numeric ids
+  and a single owner.
+
+  Data up to CHUNK_SIZE is held in the data property.  Larger data is split
+  into FileStoreChunk entities listed, in order, in chunk_keys.
+
+  """
 
   data = db.BlobProperty()
+  chunk_keys = db.ListProperty(db.Key, indexed=False)
+  size = db.IntegerProperty()
   modified = db.DateTimeProperty(auto_now=True)
+  ref_count = db.IntegerProperty(default=1)
+
+  @staticmethod
+  def hash_data(data):
+    """Returns the content hash identifying data."""
+    return hashlib.sha1(data).hexdigest()
+
+  @staticmethod
+  def key_name_for(content_hash):
+    """Returns the key name of the entity holding data with the given hash."""
+    return 'sha1-%s' % content_hash
+
+  def read(self):
+    """Returns the whole data."""
+    if self.chunk_keys:
+      return ''.join(self.iter_data())
+    return self.data
+
+  def iter_data(self):
+    """Yields the data one chunk at a time, loading each chunk on demand."""
+    if not self.chunk_keys:
+      yield self.data
+      return
+    for key in self.chunk_keys:
+      yield FileStoreChunk.get(key).data
+
+  @staticmethod
+  def acquire(data, content_hash):
+    """Adds a reference to the stored copy of data, storing it if necessary.
+
+    Args:
+      data: the file contents
+      content_hash: hash of data, as returned by hash_data
+
+    Returns:
+      The FileStoreData holding data
+
+    """
+    key_name = FileStoreData.key_name_for(content_hash)
+
+    def txn():
+      """Increments the reference count, creating the entity if needed."""
+      file_store_data = FileStoreData.get_by_key_name(key_name)
+      if file_store_data:
+        file_store_data.ref_count += 1
+      else:
+        file_store_data = FileStoreData(key_name=key_name, data=data,
+                                        size=len(data), ref_count=1)
+      file_store_data.put()
+      return file_store_data
+
+    return db.run_in_transaction(txn)
+
+  @staticmethod
+  def release(key):
+    """Removes a reference to stored data, deleting it with the last one.
+
+    Args:
+      key: key of the FileStoreData to release
+
+    """
+
+    def txn():
+      """Decrements the reference count, deleting the entity at zero.
+
+      Returns:
+        The keys of the chunks that are no longer referenced
+
+      """
+      file_store_data = FileStoreData.get(key)
+      if not file_store_data:
+        return []
+      file_store_data.ref_count -= 1
+      if file_store_data.ref_count > 0:
+        file_store_data.put()
+        return []
+      file_store_data.delete()
+      return file_store_data.chunk_keys
+
+    unused_chunk_keys = db.run_in_transaction(txn)
+    if unused_chunk_keys:
+      db.delete(unused_chunk_keys)
 
 
 class FileStore(File):
@@ -339,39 +1072,326 @@ class FileStore(File):
   This class contains a property data which abstracts the underlying child
   FileStoreData object.  The data property should be treated as though
   it were a BlobProperty.  This prevents the Blob being read into memory
-  until it is actually referenced.
+  until it is actually referenced.  New data is staged by the data property,
+  or by stage_upload for uploads of any size, and written by put.
 
   """
 
   is_hidden = db.BooleanProperty(default=False)
   url_data = db.LinkProperty()
   blob_data = db.ReferenceProperty(FileStoreData)
+  content_hash = db.StringProperty()
+  size = db.IntegerProperty()
+  mimetype = db.StringProperty()
+  extension = db.StringProperty()
+  category = db.StringProperty(choices=FILE_CATEGORIES)
+
+  activity_kind = ACTIVITY_FILE
+
+  # StagedData set through the data property and not yet written.
+  __staged = None
+
+  def put(self):
+    """Overridden to keep the file's metadata in step with its name.
+
+    Data staged through the data property is written together with the file
+    in a single transaction, followed by a single targeted cache invalidation.
+
+    """
+    self.update_metadata()
+    if self.__staged is None:
+      super(FileStore, self).put()
+      return
+
+    staged = self.__staged
+    self.__staged = None
+    content_hash = staged.content_hash
+    old_blob_key = FileStore.blob_data.get_value_for_datastore(self)
+    if ((content_hash and old_blob_key and
+         content_hash == self.content_hash) or
+        (not content_hash and not old_blob_key)):
+      super(FileStore, self).put()
+      if staged.chunk_keys:
+        db.delete(staged.chunk_keys)
+      return
+
+    def txn():
+      """Writes the file and the reference counts of its data in one batch.
+
+      Returns:
+        The keys of the chunks that are no longer referenced
+
+      """
+      new_blob = None
+      keys = []
+      if content_hash:
+        keys.append(db.Key.from_path(
+            'FileStoreData', FileStoreData.key_name_for(content_hash)))
+      if old_blob_key:
+        keys.append(old_blob_key)
+      blobs = db.get(keys)
+
+      to_put = [self]
+      to_delete = []
+      unused_chunk_keys = []
+      if content_hash:
+        new_blob = blobs.pop(0)
+        if new_blob:
+          new_blob.ref_count += 1
+          unused_chunk_keys.extend(staged.chunk_keys)
+        else:
+          new_blob = FileStoreData(
+              key_name=FileStoreData.key_name_for(content_hash),
+              data=staged.data, chunk_keys=staged.chunk_keys,
+              size=staged.size, ref_count=1)
+        to_put.append(new_blob)
+      if old_blob_key and blobs[0]:
+        old_blob = blobs[0]
+        old_blob.ref_count -= 1
+        if old_blob.ref_count > 0:
+          to_put.append(old_blob)
+        else:
+          to_delete.append(old_blob)
+          unused_chunk_keys.extend(old_blob.chunk_keys)
+
+      self.blob_data = new_blob
+      self.content_hash = content_hash
+      db.put(to_put)
+      if to_delete:
+        db.delete(to_delete)
+      return unused_chunk_keys
+
+    created = not self.is_saved()
+    options = db.create_transaction_options(xg=True)
+    unused_chunk_keys = db.run_in_transaction_options(options, txn)
+    self.record_change(created and ACTIVITY_CREATED or ACTIVITY_UPDATED)
+    self.invalidate_cache()
+    if unused_chunk_keys:
+      db.delete(unused_chunk_keys)
+    if old_blob_key:
+      self.delete_variants()
+
+  def invalidate_cache(self):
+    """Removes the cached attachment lists of the parent page.
+
+    The rendered copies of the parent page, which list its attachments, are
+    marked stale, and paths remembered as missing are forgotten, with a
+    single memcache call.  A file never moves to another page, so only the
+    current parent is affected.
+
+    """
+    parent_key = FileStore.parent_page.get_value_for_datastore(self)
+    if parent_key is None:
+      utility.memcache_incr(MISSING_PATH_GENERATION_KEY)
+      return
+    keys = ['file-list:%s:%s' % (parent_key.id(), category)
+            for category in FILE_CATEGORIES + ('all',)]
+    utility.memcache_delete(keys)
+    utility.memcache_incr_multi([Page.version_key_for(parent_key.id()),
+                                 MISSING_PATH_GENERATION_KEY])
+
+  def update_metadata(self):
+    """Derives the extension, mime type and category from the file name.
+
+    The size is maintained by the data property, as it requires the data.
+
+    """
+    self.extension, self.mimetype, self.category = FileStore.metadata_for(
+        self.name, self.url_data)
+    if self.url_data:
+      self.size = None
+
+  @staticmethod
+  def metadata_for(name, url_data=None):
+    """Returns the extension, mime type and category of a file name.
+
+    Args:
+      name: the name of the file
+      url_data: the URL the file links to, if it is a link
+
+    Returns:
+      A tuple of (extension, mime type or None, category)
+
+    """
+    extension = name.lower().split('.')[-1]
+    mimetype = mimetypes.guess_type(name)[0]
+    if url_data:
+      return extension, mimetype, CATEGORY_LINK
+    for category, extensions in CATEGORY_EXTENSIONS.items():
+      if extension in extensions:
+        return extension, mimetype, category
+    return extension, mimetype, CATEGORY_OTHER
+
+  def get_extension(self):
+    """Returns the extension, derived from the name if it is not stored.
+
+    Files saved before the metadata was stored have none until the
+    backfill_files task has run.
+
+    """
+    return self.extension or FileStore.metadata_for(self.name)[0]
+
+  def get_mimetype(self):
+    """Returns the mime type, derived from the name if it is not stored."""
+    return self.mimetype or FileStore.metadata_for(self.name)[1]
+
+  def get_category(self):
+    """Returns the category, derived from the name if it is not stored."""
+    return self.category or FileStore.metadata_for(self.name,
+                                                   self.url_data)[2]
 
   def __get_data(self):
-    """Retrieves the data from the child object."""
-    return self.blob_data.data
+    """Retrieves the data from the child object, through memcache if possible.
+
+    Content addressed data never changes, so it is cached under its hash and
+    shared by every file with the same content.
+
+    """
+    if self.__staged is not None:
+      return self.__staged.read()
+    if not self.content_hash:
+      return self.blob_data.read()
+
+    key = 'file-data:%s' % self.content_hash
+    data = utility.memcache_get(key)
+    if data is None:
+      data = self.blob_data.read()
+      if len(data) <= MAX_CACHED_DATA_SIZE:
+        utility.memcache_set(key, data)
+    return data
 
   def __set_data(self, data):
-    """Sets the data on the child object, creating one if necessary."""
+    """Stages new data for the file, to be written by the next put.
+
+    The data is stored once under its content hash and shared with every
+    other file holding the same content.
+
+    """
     if not data:
-      if self.blob_data:
-        self.blob_data.delete()
-        self.blob_data = None
-        self.put()
-      return
+      self.__stage(StagedData())
+    else:
+      self.__stage(StagedData.from_data(data))
 
-    if not self.blob_data:
-      file_store_data = FileStoreData()
-      file_store_data.put()
-      self.blob_data = file_store_data
-      self.put()
-    self.blob_data.data = data
-    self.blob_data.put()
-    self.url = None
-    self.put()
+  def stage_upload(self, uploaded_file):
+    """Stages an uploaded file without reading it into memory at once.
+
+    Args:
+      uploaded_file: a Django UploadedFile
+
+    """
+    self.__stage(StagedData.from_file(uploaded_file))
+
+  def __stage(self, staged):
+    """Replaces any previously staged data with staged."""
+    if self.__staged is not None and self.__staged.chunk_keys:
+      db.delete(self.__staged.chunk_keys)
+    self.__staged = staged
+    if staged.content_hash:
+      self.size = staged.size
+      self.url_data = None
+
+  def iter_data(self):
+    """Yields the file's data in pieces of at most CHUNK_SIZE bytes."""
+    if self.size is not None and self.size <= MAX_CACHED_DATA_SIZE:
+      yield self.data
+      return
+    for chunk in self.blob_data.iter_data():
+      yield chunk
 
   data = property(__get_data, __set_data)
 
+  @property
+  def is_image(self):
+    """Returns True if the file is an image that variants can be made of."""
+    return self.get_category() == CATEGORY_IMAGE
+
+  @property
+  def icon(self):
+    """Returns the URL of the icon representing the file's type."""
+    return '/static/images/fileicons/%s.png' % self.get_extension()
+
+  @property
+  def data_version(self):
+    """Returns a string that changes whenever the file's data changes."""
+    return self.content_hash or self.modified.strftime('%Y%m%d%H%M%S')
+
+  @property
+  def etag(self):
+    """Returns a strong HTTP entity tag for the data, or None if unknown."""
+    if not self.content_hash:
+      return None
+    return '"%s"' % self.content_hash
+
+  def variant_url(self, variant):
+    """Returns the URL of a resized variant of the image.
+
+    The URL carries the data version, so it may be cached indefinitely.
+
+    Args:
+      variant: name of the variant, a key of configuration.IMAGE_VARIANTS
+
+    Returns:
+      The URL of the variant
+
+    """
+    url = urlresolvers.reverse('views.main.get_url', args=[self.path])
+    return '%s?size=%s&v=%s' % (url, variant, self.data_version)
+
+  @property
+  def thumbnail_url(self):
+    """Returns the URL of the thumbnail of the image."""
+    return self.variant_url('thumb')
+
+  @property
+  def variant_urls(self):
+    """Returns a list of dicts describing every variant of the image."""
+    variants = [{'name': name, 'width': width,
+                 'url': self.variant_url(name)}
+                for name, width in configuration.IMAGE_VARIANTS.items()]
+    variants.sort(key=lambda variant: variant['width'])
+    return variants
+
+  def get_variant(self, variant):
+    """Returns a resized variant of the image, creating it on first use.
+
+    Variants are stored as ImageVariant children of the file and cached in
+    memcache, so the original is only read and resized once per data version.
+
+    Args:
+      variant: name of the variant, a key of configuration.IMAGE_VARIANTS
+
+    Returns:
+      The ImageVariant, or None if the variant name is unknown or the file is
+      not an image
+
+    """
+    max_width = configuration.IMAGE_VARIANTS.get(variant)
+    # The data is only read, through the data property, if the variant has
+    # to be created.
+    blob_key = FileStore.blob_data.get_value_for_datastore(self)
+    if max_width is None or not self.is_image or not blob_key:
+      return None
+    if self.size and self.size > MAX_CACHED_DATA_SIZE:
+      # Too large for the images API and for a variant entity.
+      return None
+
+    key_name = '%s:%s' % (variant, self.data_version)
+    key = 'variant:%s:%s' % (self.key().id(), key_name)
+    image_variant = utility.memcache_get(key)
+    if image_variant:
+      return image_variant
+
+    image_variant = ImageVariant.get_by_key_name(key_name, parent=self)
+    if not image_variant:
+      image_variant = ImageVariant.create(self, key_name, max_width)
+    utility.memcache_set(key, image_variant)
+    return image_variant
+
+  def delete_variants(self):
+    """Deletes every stored variant of the file."""
+    if self.is_saved():
+      db.delete(ImageVariant.all(keys_only=True).ancestor(self))
+
   def __get_url(self):
     """Exposes the url property."""
     return self.url_data
@@ -388,9 +1408,74 @@ class FileStore(File):
 
   def delete(self):
     """Overridden to ensure child objects are cleaned up on delete."""
-    if self.blob_data:
-      self.blob_data.delete()
+    blob_key = FileStore.blob_data.get_value_for_datastore(self)
+    self.delete_variants()
     super(FileStore, self).delete()
+    if blob_key:
+      FileStoreData.release(blob_key)
+
+
+class ImageVariant(db.Model):
+  """A resized copy of an image attachment.
+
+  Variants are children of their FileStore and are keyed by the variant name
+  and the data version of the original.
+
+  """
+
+  data = db.BlobProperty()
+  mimetype = db.StringProperty()
+  width = db.IntegerProperty()
+  created = db.DateTimeProperty(auto_now_add=True)
+
+  @staticmethod
+  def create(file_store, key_name, max_width):
+    """Resizes an image attachment and stores the result.
+
+    Images that are already narrower than max_width are stored unchanged, as
+    are images the images API cannot decode.
+
+    Args:
+      file_store: the FileStore holding the original image
+      key_name: key name of the new variant
+      max_width: maximum width of the variant in pixels
+
+    Returns:
+      The stored ImageVariant
+
+    """
+    from google.appengine.api import images  # pylint: disable-msg=W0404
+
+    data = file_store.data
+    mimetype = file_store.get_mimetype()
+    width = None
+    try:
+      image = images.Image(data)
+      width = image.width
+      if width > max_width:
+        image.resize(width=max_width)
+        if mimetype == 'image/jpeg':
+          data = image.execute_transforms(output_encoding=images.JPEG)
+        else:
+          data = image.execute_transforms(output_encoding=images.PNG)
+          mimetype = 'image/png'
+        width = max_width
+    except images.Error, err:
+      logging.warning('Could not resize %s: %s', file_store.name, err)
+
+    image_variant = ImageVariant(key_name=key_name, parent=file_store,
+                                 data=db.Blob(data), mimetype=mimetype,
+                                 width=width)
+    image_variant.put()
+    return image_variant
+
+
+# Largest number of values the datastore accepts in an IN filter, used to
+# find profiles that have no UserProfileEmail yet.
+PROFILE_QUERY_BATCH_SIZE = 30
+
+# Largest number of entities written or deleted in one datastore call.
+WRITE_BATCH_SIZE = 500
 
 
 class UserProfile(db.Model):
@@ -416,47 +1501,103 @@ class UserProfile(db.Model):
 
     """
     key = 'email:' + email
-    profile = utility.memcache_get(key)
+    profile = utility.memcache_get(key, memo=True)
     if not profile:
-      profile = UserProfile.all().filter('email =', email).get()
-      utility.memcache_set(key, profile)
+      profile_key = UserProfileEmail.profile_keys([email]).get(email)
+      profile = profile_key and UserProfile.get(profile_key)
+      utility.memcache_set(key, profile, memo=True)
     return profile
 
+  @staticmethod
+  def load_many(emails):
+    """Retrieves the profiles of several users, through memcache if possible.
+
+    Profiles missing from memcache are found through their UserProfileEmail
+    entities with two batch gets.
+
+    Args:
+      emails: email addresses of the profiles to load
+
+    Returns:
+      A dict mapping each email address that has a profile to the profile
+
+    """
+    keys = dict([('email:' + email, email) for email in emails])
+    cached = utility.memcache_get_multi(keys.keys())
+    profiles = dict([(keys[key], profile)
+                     for key, profile in cached.items() if profile])
+
+    missing = [email for email in set(emails) if email not in profiles]
+    found = {}
+    profile_keys = UserProfileEmail.profile_keys(missing)
+    for profile in db.get(profile_keys.values()):
+      if profile:
+        profiles[profile.email] = profile
+        found['email:' + profile.email] = profile
+    if found:
+      utility.memcache_set_multi(found)
+    return profiles
+
   def put(self):
-    """Saves the profile and flushes the memcache."""
+    """Saves the profile with its UserProfileEmail and flushes the memcache."""
     super(UserProfile, self).put()
+    UserProfileEmail(key=UserProfileEmail.key_for(self.email),
+                     profile=self).put()
     utility.clear_memcache()
 
+  @property
+  def group_ids(self):
+    """Returns the set of the ids of the groups the user is in.
+
+    Groups that have not been migrated to memberships yet are found through
+    their users list.
+
+    Returns:
+      A frozenset of group ids
+
+    """
+    key = 'user-group-ids:%s' % self.key().id()
+    group_ids = utility.memcache_get(key, memo=True)
+    if group_ids is None:
+      query = GroupMembership.all(keys_only=True).filter('user =', self.key())
+      legacy = UserGroup.all(keys_only=True).filter('users =', self.key())
+      group_ids = frozenset(
+          [GroupMembership.group_id_of(membership_key)
+           for membership_key in query] +
+          [group_key.id() for group_key in legacy])
+      utility.memcache_set(key, group_ids, memo=True)
+    return group_ids
+
   @property
   def groups(self):
-    """Returns a list of all of the groups the user is in.
+    """Returns the groups the user is in, ordered by name.
 
     Returns:
-      The list of groups the user is in
+      A list of dicts with the id and name of each group
 
     """
-    key = 'users_groups:%s' % self.key().id()
-    groups = utility.memcache_get(key)
-    if not groups:
-      groups = list(UserGroup.all().filter('users = ', self.key()))
-      utility.memcache_set(key, groups)
-    return groups
+    group_ids = self.group_ids
+    return [{'id': group_id, 'name': name}
+            for group_id, name in UserGroup.all_group_names()
+            if group_id in group_ids]
 
   @property
   def groups_not_in(self):
-    """Returns a list of all of the groups the user is not in.
+    """Returns the groups the user is not in, ordered by name.
 
     Returns:
-      The list of groups the user is not in
+      A list of dicts with the id and name of each group
 
     """
-    all_group_keys = [g.key().id() for g in UserGroup.all_groups()]
-    self_group_keys = [g.key().id() for g in self.groups]
-    not_in_group_keys = [k for k in all_group_keys if k not in self_group_keys]
-    return UserGroup.get_by_id(not_in_group_keys)
+    group_ids = self.group_ids
+    return [{'id': group_id, 'name': name}
+            for group_id, name in UserGroup.all_group_names()
+            if group_id not in group_ids]
 
   def delete(self):
-    """Overridden to ensure memcache is cleared."""
+    """Overridden to remove the user from their groups and clear memcache."""
+    db.delete(GroupMembership.all(keys_only=True).filter('user =', self.key()))
+    db.delete(UserProfileEmail.key_for(self.email))
     super(UserProfile, self).delete()
     utility.clear_memcache()
 
@@ -472,6 +1613,8 @@ class UserProfile(db.Model):
       True if the user is created/edited, False if the email address is invalid
 
     """
+    from django.core import validators  # pylint: disable-msg=W0404
+
     if not validators.email_re.search(email):
       return False
 
@@ -487,7 +1630,15 @@ class UserProfile(db.Model):
 
 class UserGroup(db.Model):
   # pylint: disable-msg=R0904
-  """Model for logically grouping users for access control."""
+  """Model for logically grouping users for access control.
+
+  Members are stored as GroupMembership entities.  Groups saved before
+  memberships existed keep their members in the users list until they are
+  migrated, and those members keep their access in the meantime.  A group is
+  migrated by the migrate_group_members task, or as soon as its members are
+  listed or changed.
+
+  """
 
   name = db.StringProperty(required=True)
   description = db.StringProperty()
@@ -498,33 +1649,314 @@ class UserGroup(db.Model):
     return encoding.smart_str(self.name)
 
   def put(self):
-    """Overridden method to ensure name is kept unique."""
-    for group in UserGroup.all().filter('name = ', self.name):
-      if not self.is_saved() or group.key() != self.key():
+    """Overridden method to ensure name is kept unique.
+
+    The group is saved together with the UserGroupName entity claiming its
+    name, in one transaction, so two groups can never take the same name.
+    Groups saved before names were claimed are found by a query, as the
+    index_group_names task may not have claimed their names yet.
+
+    Raises:
+      BadValueError: another group already has the name
+
+    """
+    name_key = UserGroupName.key_for(self.name)
+    query = UserGroup.all(keys_only=True).filter('name =', self.name)
+    for group_key in query.fetch(2):
+      if not self.is_saved() or group_key != self.key():
         raise db.BadValueError('There is already a group named "%s"'
                                % self.name)
-    super(UserGroup, self).put()
+
+    def txn():
+      """Claims the group's name and saves the group."""
+      if self.is_saved():
+        stored, claim = db.get([self.key(), name_key])
+      else:
+        stored, claim = None, db.get(name_key)
+      if claim and (not self.is_saved() or claim.group_key() != self.key()):
+        raise db.BadValueError('There is already a group named "%s"'
+                               % self.name)
+      super(UserGroup, self).put()
+      if not claim:
+        UserGroupName(key=name_key, group=self).put()
+      if stored and UserGroupName.key_for(stored.name) != name_key:
+        db.delete(UserGroupName.key_for(stored.name))
+
+    options = db.create_transaction_options(xg=True)
+    db.run_in_transaction_options(options, txn)
     utility.clear_memcache()
 
   def delete(self):
-    """Overridden to ensure memcache is cleared."""
-    super(UserGroup, self).delete()
+    """Overridden to release the group's name and clear the memcache."""
+    name_key = UserGroupName.key_for(self.name)
+
+    def txn():
+      """Deletes the group and its name claim."""
+      claim = db.get(name_key)
+      if claim and claim.group_key() == self.key():
+        claim.delete()
+      super(UserGroup, self).delete()
+
+    options = db.create_transaction_options(xg=True)
+    db.run_in_transaction_options(options, txn)
+    if not GroupMembership.delete_batch(self.key()):
+      from google.appengine.api import taskqueue  # pylint: disable-msg=W0404
+      taskqueue.add(
+          url=utility.task_url('delete_group_members'),
+          params={'group_id': self.key().id()})
+    utility.clear_memcache()
+
+  def migrate_members(self, limit=WRITE_BATCH_SIZE):
+    """Moves members of the legacy users list to GroupMembership entities.
+
+    Args:
+      limit: maximum number of members to move
+
+    Returns:
+      The number of members moved
+
+    """
+    moved = self.users[:limit]
+    if not moved:
+      return 0
+    db.put([GroupMembership(key=GroupMembership.key_for(self.key(), user_key),
+                            group=self.key(), user=user_key)
+            for user_key in moved])
+    self.users = self.users[limit:]
+    # Saved directly, bypassing put and its name check.
+    db.put(self)
+    return len(moved)
+
+  def ensure_migrated(self):
+    """Moves every member of the legacy users list, in batches."""
+    while self.migrate_members():
+      pass
+
+  def add_user(self, user_key):
+    """Makes a user a member of the group.
+
+    Args:
+      user_key: key of the UserProfile to add
+
+    """
+    self.ensure_migrated()
+    GroupMembership(key=GroupMembership.key_for(self.key(), user_key),
+                    group=self.key(), user=user_key).put()
+    utility.clear_memcache()
+
+  def remove_user(self, user_key):
+    """Removes a user from the group.
+
+    Args:
+      user_key: key of the UserProfile to remove
+
+    """
+    self.ensure_migrated()
+    db.delete(GroupMembership.key_for(self.key(), user_key))
     utility.clear_memcache()
 
+  def update_members(self, add_emails, remove_emails):
+    """Adds and removes many members of the group at once.
+
+    The profiles are loaded in one batch and the memberships are written
+    and deleted in batches of WRITE_BATCH_SIZE, followed by a single cache
+    flush.  An address in both lists is removed.
+
+    Args:
+      add_emails: email addresses of the users to add
+      remove_emails: email addresses of the users to remove
+
+    Returns:
+      A sorted list of the email addresses that have no profile
+
+    """
+    self.ensure_migrated()
+    profiles = UserProfile.load_many(list(add_emails) + list(remove_emails))
+    unknown = set([email for email in add_emails if email not in profiles])
+    unknown.update([email for email in remove_emails
+                    if email not in profiles])
+
+    removed = set([profiles[email].key() for email in remove_emails
+                   if email in profiles])
+    added = set([profiles[email].key() for email in add_emails
+                 if email in profiles]) - removed
+    memberships = [GroupMembership(
+                       key=GroupMembership.key_for(self.key(), user_key),
+                       group=self.key(), user=user_key)
+                   for user_key in added]
+    removals = [GroupMembership.key_for(self.key(), user_key)
+                for user_key in removed]
+
+    for start in range(0, len(memberships), WRITE_BATCH_SIZE):
+      db.put(memberships[start:start + WRITE_BATCH_SIZE])
+    for start in range(0, len(removals), WRITE_BATCH_SIZE):
+      db.delete(removals[start:start + WRITE_BATCH_SIZE])
+    if memberships or removals:
+      utility.clear_memcache()
+    return sorted(unknown)
+
+  def member_keys(self, limit, cursor=None):
+    """Returns one page of the keys of the group's members.
+
+    Args:
+      limit: maximum number of keys to return
+      cursor: cursor returned with the previous page, if any
+
+    Returns:
+      A tuple of (list of UserProfile keys, cursor for the next page or None)
+
+    """
+    self.ensure_migrated()
+    query = GroupMembership.all().filter('group =', self.key())
+    if cursor:
+      query.with_cursor(cursor)
+    memberships = query.fetch(limit)
+    user_keys = [GroupMembership.user.get_value_for_datastore(membership)
+                 for membership in memberships]
+    if len(memberships) < limit:
+      return user_keys, None
+    return user_keys, query.cursor()
+
+  @staticmethod
+  def get_by_name(name):
+    """Returns the group with the given name, or None if there is none."""
+    claim = UserGroupName.get(UserGroupName.key_for(name))
+    if claim:
+      return UserGroup.get(claim.group_key())
+    return None
+
   @staticmethod
-  def all_groups():
-    """Returns a list of all of the groups in the system.
+  def all_group_names():
+    """Returns the id and name of every group, without the member lists.
 
     Returns:
-      A list of all groups
+      A list of (id, name) tuples ordered by name
 
     """
-    key = 'all_groups:'
-    groups = utility.memcache_get(key)
-    if not groups:
-      groups = list(UserGroup.all())
-      utility.memcache_set(key, groups)
-    return groups
+    key = 'group-names'
+    names = utility.memcache_get(key)
+    if names is None:
+      names = [(group.key().id(), group.name)
+               for group in UserGroup.all().order('name')]
+      utility.memcache_set(key, names)
+    return names
+
+
+# Number of memberships deleted per batch when a group is deleted.
+MEMBERSHIP_DELETE_BATCH_SIZE = 500
+
+
+class GroupMembership(db.Model):
+  """Records that a user is a member of a group.
+
+  Each membership is its own root entity, keyed by the ids of the group and
+  the user, so adding, removing and checking a membership costs the same
+  whatever the size of the group.  Members of a group and groups of a user
+  are found with indexed queries.
+
+  """
+
+  group = db.ReferenceProperty(UserGroup, collection_name='memberships')
+  user = db.ReferenceProperty(UserProfile, collection_name='memberships')
+
+  @staticmethod
+  def key_for(group_key, user_key):
+    """Returns the key of the membership of a user in a group."""
+    return db.Key.from_path('GroupMembership',
+                            'g%s-u%s' % (group_key.id(), user_key.id()))
+
+  @staticmethod
+  def group_id_of(membership_key):
+    """Returns the group id encoded in the key of a membership."""
+    return int(membership_key.name()[1:].split('-')[0])
+
+  @staticmethod
+  def delete_batch(group_key):
+    """Deletes up to MEMBERSHIP_DELETE_BATCH_SIZE memberships of a group.
+
+    Args:
+      group_key: key of the group
+
+    Returns:
+      True if the group has no memberships left
+
+    """
+    query = GroupMembership.all(keys_only=True).filter('group =', group_key)
+    keys = query.fetch(MEMBERSHIP_DELETE_BATCH_SIZE)
+    db.delete(keys)
+    return len(keys) < MEMBERSHIP_DELETE_BATCH_SIZE
+
+
+class UserGroupName(db.Model):
+  """Claims a group name for one UserGroup.
+
+  The key name is derived from the normalized group name, so finding the
+  group with a name, or checking that a name is free, is a single get.
+
+  """
+
+  group = db.ReferenceProperty(UserGroup, collection_name='name_claims')
+
+  @staticmethod
+  def key_for(name):
+    """Returns the key of the entity claiming a group name."""
+    return db.Key.from_path('UserGroupName',
+                            'name:%s' % name.strip().lower())
+
+  def group_key(self):
+    """Returns the key of the group holding the name, without fetching it."""
+    return UserGroupName.group.get_value_for_datastore(self)
+
+
+class UserProfileEmail(db.Model):
+  """Maps an email address to the key of its UserProfile.
+
+  The key name is derived from the email address, so the profiles of any
+  number of addresses are found with two batch gets instead of a query per
+  address.  Profiles saved before these entities existed are found with a
+  query until the index_profile_emails task has run and
+  configuration.PROFILE_EMAILS_INDEXED is set.
+
+  """
+
+  profile = db.ReferenceProperty(UserProfile, collection_name='email_lookups')
+
+  @staticmethod
+  def key_for(email):
+    """Returns the key of the entity mapping an email address."""
+    return db.Key.from_path('UserProfileEmail', 'email:%s' % email)
+
+  def profile_key(self):
+    """Returns the key of the profile, without fetching it."""
+    return UserProfileEmail.profile.get_value_for_datastore(self)
+
+  @staticmethod
+  def profile_keys(emails):
+    """Finds the keys of the profiles of several email addresses.
+
+    Args:
+      emails: list of email addresses
+
+    Returns:
+      A dict mapping each email address that has a profile to its key
+
+    """
+    lookups = db.get([UserProfileEmail.key_for(email) for email in emails])
+    profile_keys = {}
+    unindexed = []
+    for email, lookup in zip(emails, lookups):
+      if lookup:
+        profile_keys[email] = lookup.profile_key()
+      else:
+        unindexed.append(email)
+
+    if not configuration.PROFILE_EMAILS_INDEXED:
+      for start in range(0, len(unindexed), PROFILE_QUERY_BATCH_SIZE):
+        batch = unindexed[start:start + PROFILE_QUERY_BATCH_SIZE]
+        query = UserProfile.all().filter('email IN', batch)
+        for profile in query:
+          profile_keys[profile.email] = profile.key()
+    return profile_keys
 
 
 class Sidebar(db.Model):
@@ -549,10 +1981,32 @@ class Sidebar(db.Model):
               pass
 
   def put(self):
-    """Saves the sidebar and flushes the memcache."""
+    """Saves the sidebar and records the change.
+
+    The memcache is not flushed: the rendered sidebars are marked stale, so
+    that they are served while a task renders them again, and only the
+    cached sidebar membership of the pages listed before or after the change
+    is deleted.
+
+    """
     self.__try_parse()
+    stored = Sidebar.load()
     super(Sidebar, self).put()
-    utility.clear_memcache()
+    Activity.record(ACTIVITY_SIDEBAR, ACTIVITY_UPDATED)
+    page_ids = self.page_ids()
+    if stored:
+      page_ids |= stored.page_ids()
+    utility.memcache_delete(['page-in-sidebar:%s' % page_id
+                             for page_id in page_ids])
+    utility.soft_invalidate(SIDEBAR_VERSION_KEY)
+
+  def page_ids(self):
+    """Returns the set of the ids of the pages listed in the sidebar."""
+    page_ids = set()
+    for section in yaml.load_all(self.yaml):
+      for item in section.get('pages') or []:
+        page_ids.add(item['id'])
+    return page_ids
 
   @staticmethod
   def load():
@@ -614,17 +2068,22 @@ class Sidebar(db.Model):
     sidebar.put()
 
   @staticmethod
-  def render(profile):
+  def render(profile, refresh=False):
     """Retrieves the HTML for the sidebar.
 
     This method first checks the memcache layer for rendered HTML based on the
     given profile's access level and returns it if found.  If the HTML is not
     found, the sidebar's definition is loaded and each page is checked for
     existence and if the profile's access level has rights to view the page.
-    HTML is then rendered and stored in memcache for future accesses
+    The pages are fetched in one batch, and a section none of whose pages
+    can be read is skipped with a single check.  HTML is then rendered and
+    stored in memcache for future accesses.  HTML rendered before the sidebar
+    was last saved is returned as well, and a task is queued to render it
+    again.
 
     Args:
       profile: profile of the user accessing the sidebar
+      refresh: whether to render the HTML even if it is cached
 
     Returns:
       A string containing the HTML of the sidebar for the given profile's
@@ -636,22 +2095,37 @@ class Sidebar(db.Model):
     else:
       key = 'sidebar'
          
-    html = utility.memcache_get(key)
-    if html:
+    lease = not refresh
+    html, fresh, versions = utility.memcache_get_versioned(
+        key, [SIDEBAR_VERSION_KEY], lease=lease)
+    if html is not None and not refresh:
+      if not fresh:
+        utility.queue_refresh(key, kind='sidebar',
+                              item_id=profile and profile.key().id() or 0)
       return html
 
     html = []
     sidebar = Sidebar.load()
 
     if not sidebar:
+      utility.memcache_set_versioned(key, '', versions, lease=lease)
       return ''
 
-    for section in yaml.load_all(sidebar.yaml):
+    sections = list(yaml.load_all(sidebar.yaml))
+    page_ids = [int(item['id']) for section in sections
+                for item in section['pages']]
+    pages = dict(zip(page_ids, Page.get_by_id(page_ids)))
+
+    for section in sections:
       section_html = []
+      section_pages = [pages[int(item['id'])] for item in section['pages']
+                       if pages[int(item['id'])]]
+      if not AccessControlList.can_read_any(section_pages, profile):
+        continue
 
       for item in section['pages']:
         # pylint: disable-msg=E1103
-        page = Page.get_by_id(int(item['id']))
+        page = pages[int(item['id'])]
         if not page or not page.user_can_read(profile):
           continue
         url = urlresolvers.reverse('views.main.get_url', args=[page.path])
@@ -663,5 +2137,5 @@ class Sidebar(db.Model):
         html.append('<ul>\n%s</ul>\n' % ''.join(section_html))
 
     html = ''.join(html)
-    utility.memcache_set(key, html)
+    utility.memcache_set_versioned(key, html, versions, lease=lease)
     return html
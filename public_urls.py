@@ -0,0 +1,99 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Defines the url patterns used to serve visitors who are not signed in.
+
+AddUserToRequestMiddleware resolves the requests of anonymous visitors with
+these patterns, so that neither resolving nor reversing a URL while serving
+them imports the admin views.  The task patterns are kept so that the views
+of the public path can still queue tasks by name; their views are only
+imported if one of them is called.
+
+"""
+
+# pylint: disable-msg=C0103,C0301
+
+from django.conf.urls import defaults
+from django.core import urlresolvers
+
+# Views of views.tasks that are mapped under /_tasks/, reversed as
+# 'task-<name>' with utility.task_url.
+TASKS = (
+    'backfill_files',
+    'deduplicate_files',
+    'index_group_names',
+    'index_profile_emails',
+    'migrate_group_members',
+    'delete_group_members',
+    'page_changed',
+    'rebuild_sitemap',
+    'warm_cache',
+    'refresh_cache',
+    'store_view_counts',
+    'rebuild_search_index',
+)
+
+
+class LazyView(object):
+  # pylint: disable-msg=R0903
+  """A view that imports the function it calls the first time it is used.
+
+  Django imports the module of every view named by a string as soon as a URL
+  is reversed, so patterns that must not load their module use this instead.
+
+  """
+
+  def __init__(self, name):
+    self.name = name
+
+  def __call__(self, request, *args, **kwds):
+    view = urlresolvers.get_callable(self.name)
+    return view(request, *args, **kwds)  # pylint: disable-msg=W0142
+
+
+def task_patterns(lazy):
+  """Returns the patterns of the views of views.tasks.
+
+  Args:
+    lazy: whether the views are only imported when a task is called
+
+  Returns:
+    A list of url patterns named 'task-<name>'
+  """
+  patterns = []
+  for name in TASKS:
+    view = 'views.tasks.%s' % name
+    if lazy:
+      view = LazyView(view)
+    patterns.append(defaults.url(r'^_tasks/%s/$' % name, view,
+                                 name='task-%s' % name))
+  return defaults.patterns('', *patterns)  # pylint: disable-msg=W0142
+
+
+public_patterns = defaults.patterns(
+    'views',
+    (r'^sitemap/$', 'main.page_list'),
+    (r'^sitemap.xml$', 'main.sitemap_xml'),
+    (r'^sitemap-(\d+).xml$', 'main.sitemap_shard_xml'),
+    (r'^search/$', 'main.search_pages'),
+    (r'^_signin/$', 'main.sign_in'),
+    (r'^(.*)$', 'main.get_url'),
+)
+
+urlpatterns = task_patterns(True) + public_patterns
+
+handler404 = 'utility.page_not_found'
+handler500 = defaults.handler500
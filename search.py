@@ -0,0 +1,364 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Full-text search over page titles and content.
+
+Pages are split into stemmed terms, and each term has a posting list mapping
+page ids to the weight of the term in the page.  A term's posting list is
+split over a fixed number of TERM_SHARDS entities by page id, so that edits
+to different pages rarely touch the same entity.  Each shard still grows with
+the number of pages containing its term: a posting takes about ten bytes, so
+a term reaches the 1 MB entity limit at roughly TERM_SHARDS * 100,000 pages.
+The terms of each page are kept in a PageTerms entity, so that re-indexing a
+page only rewrites the postings of the terms whose weight changed.  The
+PageTerms entity also orders concurrent updates of the same page, so that the
+postings always end up matching the latest content.
+
+A query reads every shard of each of its terms with a single batch get.  The
+number of datastore calls is independent of the size of the site, but the
+data read and scored grows with the number of pages containing the terms, so
+common terms cost the most.
+
+"""
+
+import htmlentitydefs
+import math
+import re
+
+from google.appengine.ext import db
+
+# Number of entities the posting list of each term is split over.  Changing
+# it requires rebuilding the search index.
+TERM_SHARDS = 8
+
+# Weight of a term in the title, relative to one occurrence in the content.
+TITLE_WEIGHT = 5
+
+# Largest number of distinct terms indexed per page.
+MAX_PAGE_TERMS = 2000
+
+# Longest word indexed; longer words are usually not words at all.
+MAX_WORD_LENGTH = 40
+
+# Largest number of terms used from a query.
+MAX_QUERY_TERMS = 8
+
+# Largest number of posting entities written in one transaction, which also
+# reads the PageTerms entity; a cross group transaction may touch at most 25
+# entity groups.
+POSTINGS_PER_TRANSACTION = 24
+
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from',
+    'has', 'have', 'in', 'into', 'is', 'it', 'its', 'of', 'on', 'or', 'that',
+    'the', 'their', 'there', 'these', 'this', 'to', 'was', 'were', 'will',
+    'with'])
+
+# Suffixes removed by stem, longest first, with their replacements.
+SUFFIXES = (
+    ('ational', 'ate'), ('iveness', 'ive'), ('fulness', 'ful'),
+    ('ousness', 'ous'), ('ization', 'ize'), ('ation', 'ate'), ('ments', ''),
+    ('ement', ''), ('ness', ''), ('ment', ''), ('ings', ''), ('ies', 'y'),
+    ('ing', ''), ('ers', ''), ('ed', ''), ('er', ''), ('ly', ''), ('es', ''),
+    ('s', ''))
+
+TAG_RE = re.compile(r'<[^>]*>')
+ENTITY_RE = re.compile(r'&(#?\w+);')
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class TermPostings(db.Model):
+  """One shard of the posting list of a term.
+
+  The postings are stored as text, 'page_id:weight' separated by spaces,
+  which is far smaller than a list property and is not indexed.  A shard
+  holds the postings of every page whose id falls in it, so it grows with
+  the number of pages containing the term.
+
+  """
+
+  postings = db.TextProperty()
+
+  @staticmethod
+  def key_for(term, page_id):
+    """Returns the key of the shard holding the posting of a term for a page.
+
+    Args:
+      term: a stemmed term
+      page_id: id of the page
+
+    """
+    return db.Key.from_path('TermPostings',
+                            't:%s:%d' % (term, page_id % TERM_SHARDS))
+
+  def get_postings(self):
+    """Returns the postings as a dict mapping page ids to weights."""
+    return decode_weights(self.postings, int)
+
+  def set_postings(self, postings):
+    """Sets the postings from a dict mapping page ids to weights."""
+    self.postings = db.Text(encode_weights(postings))
+
+
+class PageTerms(db.Model):
+  """The terms a page was last indexed with, and their weights.
+
+  Each update of the page's postings increments the generation, and the
+  terms whose postings it has not rewritten yet are listed as unsettled.  An
+  update that finds a newer generation stops, and the newer update rewrites
+  the terms left unsettled as well as its own.
+
+  """
+
+  terms = db.TextProperty()
+  unsettled = db.TextProperty()
+  generation = db.IntegerProperty(default=0)
+
+  @staticmethod
+  def key_for(page_id):
+    """Returns the key of the terms of a page."""
+    return db.Key.from_path('PageTerms', 'p%d' % page_id)
+
+  def get_unsettled(self):
+    """Returns the set of terms whose postings may not match the terms."""
+    return set((self.unsettled or u'').split())
+
+  def set_unsettled(self, terms):
+    """Sets the terms whose postings may not match the terms."""
+    self.unsettled = db.Text(u' '.join(sorted(terms)))
+
+
+def encode_weights(weights):
+  """Encodes a dict of weights as text, sorted for a stable result."""
+  return u' '.join([u'%s:%d' % item for item in sorted(weights.items())])
+
+
+def decode_weights(text, key_type):
+  """Decodes text written by encode_weights.
+
+  Args:
+    text: the encoded weights, or None
+    key_type: function converting each key, such as int or unicode
+
+  Returns:
+    A dict mapping keys to integer weights
+
+  """
+  weights = {}
+  for item in (text or u'').split():
+    key, weight = item.rsplit(':', 1)
+    weights[key_type(key)] = int(weight)
+  return weights
+
+
+def replace_entity(match):
+  """Returns the character for an HTML entity, or a space if it is unknown."""
+  name = match.group(1)
+  try:
+    if name.startswith('#x'):
+      return unichr(int(name[2:], 16))
+    if name.startswith('#'):
+      return unichr(int(name[1:]))
+    return unichr(htmlentitydefs.name2codepoint[name])
+  except (KeyError, ValueError, OverflowError):
+    return u' '
+
+
+def stem(word):
+  """Reduces a word to its stem by removing common English suffixes.
+
+  Args:
+    word: a lower-case word
+
+  Returns:
+    The stem of the word; short words are returned unchanged
+
+  """
+  for suffix, replacement in SUFFIXES:
+    if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+      return word[:-len(suffix)] + replacement
+  return word
+
+
+def tokenize(text):
+  """Splits text, which may contain HTML, into stemmed search terms.
+
+  Args:
+    text: the text to split
+
+  Returns:
+    A list of terms in the order they occur, without stop words
+
+  """
+  text = ENTITY_RE.sub(replace_entity, TAG_RE.sub(u' ', text or u''))
+  return [stem(word) for word in WORD_RE.findall(text.lower())
+          if 1 < len(word) <= MAX_WORD_LENGTH and word not in STOP_WORDS]
+
+
+def page_terms(title, content):
+  """Returns the weight of each term in a page.
+
+  Args:
+    title: title of the page
+    content: HTML content of the page
+
+  Returns:
+    A dict mapping terms to weights, limited to the MAX_PAGE_TERMS heaviest
+
+  """
+  weights = {}
+  for term in tokenize(content):
+    weights[term] = weights.get(term, 0) + 1
+  for term in tokenize(title):
+    weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+  if len(weights) > MAX_PAGE_TERMS:
+    heaviest = sorted(weights.items(), key=lambda item: -item[1])
+    weights = dict(heaviest[:MAX_PAGE_TERMS])
+  return weights
+
+
+def update_page(page_key):
+  """Indexes a page, rewriting only the postings that may have changed.
+
+  The page is read in the transaction that records its new terms, so that
+  concurrent updates of a page are applied in order, and each transaction
+  writing postings checks that no later update has started since.
+
+  Args:
+    page_key: key of the page, which may have been deleted
+
+  """
+  page_id = page_key.id()
+  page_terms_key = PageTerms.key_for(page_id)
+
+  def start_txn():
+    """Records the new terms of the page and the postings to rewrite."""
+    page, stored = db.get([page_key, page_terms_key])
+    if stored is None:
+      stored = PageTerms(key=page_terms_key)
+    old_weights = decode_weights(stored.terms, unicode)
+    new_weights = {}
+    if page:
+      new_weights = page_terms(page.title or u'', page.content)
+
+    unsettled = stored.get_unsettled()
+    for term in set(old_weights) | set(new_weights):
+      if old_weights.get(term, 0) != new_weights.get(term, 0):
+        unsettled.add(term)
+    stored.terms = db.Text(encode_weights(new_weights))
+    stored.set_unsettled(unsettled)
+    stored.generation += 1
+    stored.put()
+    return stored.generation, new_weights, unsettled
+
+  options = db.create_transaction_options(xg=True)
+  generation, new_weights, unsettled = db.run_in_transaction_options(
+      options, start_txn)
+  changed = dict([(TermPostings.key_for(term, page_id),
+                   new_weights.get(term, 0)) for term in unsettled])
+  keys = changed.keys()
+
+  def txn(batch):
+    """Applies the new weights to one batch of posting shards.
+
+    Returns:
+      False if a later update of the page has started, True otherwise
+    """
+    stored = db.get(page_terms_key)
+    if stored is None or stored.generation != generation:
+      return False
+    to_put = []
+    to_delete = []
+    for key, shard in zip(batch, db.get(batch)):
+      if shard is None:
+        shard = TermPostings(key=key)
+      postings = shard.get_postings()
+      if changed[key]:
+        postings[page_id] = changed[key]
+      else:
+        postings.pop(page_id, None)
+      if postings:
+        shard.set_postings(postings)
+        to_put.append(shard)
+      elif shard.is_saved():
+        to_delete.append(shard)
+    db.put(to_put)
+    db.delete(to_delete)
+    return True
+
+  for start in range(0, len(keys), POSTINGS_PER_TRANSACTION):
+    if not db.run_in_transaction_options(
+        options, txn, keys[start:start + POSTINGS_PER_TRANSACTION]):
+      return
+
+  def finish_txn():
+    """Marks the postings as matching the terms of the page."""
+    stored = db.get(page_terms_key)
+    if stored is None or stored.generation != generation:
+      return
+    if new_weights:
+      stored.set_unsettled([])
+      stored.put()
+    else:
+      stored.delete()
+
+  db.run_in_transaction(finish_txn)
+
+
+def search(query):
+  """Finds the pages matching every term of a query.
+
+  Args:
+    query: the text typed by the user
+
+  Returns:
+    A list of page ids, best match first.  Each page is scored by the sum of
+    the weights of the query terms in the page, with rarer terms counting
+    for more.
+
+  """
+  terms = []
+  for term in tokenize(query):
+    if term not in terms:
+      terms.append(term)
+  terms = terms[:MAX_QUERY_TERMS]
+  if not terms:
+    return []
+
+  keys = [TermPostings.key_for(term, shard)
+          for term in terms for shard in range(TERM_SHARDS)]
+  shards = db.get(keys)
+
+  scores = None
+  for index in range(len(terms)):
+    postings = {}
+    for shard in shards[index * TERM_SHARDS:(index + 1) * TERM_SHARDS]:
+      if shard:
+        postings.update(shard.get_postings())
+    if not postings:
+      return []
+    rarity = 1.0 / math.log(1.0 + len(postings))
+    if scores is None:
+      scores = dict([(page_id, weight * rarity)
+                     for page_id, weight in postings.items()])
+    else:
+      scores = dict([(page_id, score + postings[page_id] * rarity)
+                     for page_id, score in scores.items()
+                     if page_id in postings])
+
+  ranked = sorted(scores.items(), key=lambda item: -item[1])
+  return [page_id for page_id, _ in ranked]
@@ -0,0 +1,266 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Sitemap of the publicly readable pages and attachments for crawlers.
+
+Pages are split by key into shards of about SHARD_SIZE pages.  Each shard
+stores the paths and modification dates of its public pages and attachments
+in a SitemapShard entity, built by a task.  Serving a sitemap only reads the
+stored shards.  When a page or attachment changes, only the entries of that
+page are replaced in the shard covering it; ACL changes and pages being
+renamed or moved rebuild every shard.
+
+"""
+
+import urllib
+from xml.sax import saxutils
+
+from google.appengine.ext import db
+import models
+import utility
+
+# Number of pages covered by each shard when the shards are rebuilt.
+SHARD_SIZE = 500
+
+# Largest number of values the datastore accepts in an IN filter.
+FILE_QUERY_BATCH_SIZE = 30
+
+SITEMAP_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<%s xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+
+
+class SitemapShard(db.Model):
+  """The sitemap entries of the pages from start_key up to the next shard.
+
+  Entries are stored as text, one 'page_id<TAB>path<TAB>YYYY-MM-DD' line per
+  URL, where page_id is the id of the page or of the page an attachment
+  belongs to.  The first shard has no start_key, which sorts before every
+  key.
+
+  """
+
+  number = db.IntegerProperty(required=True)
+  start_key = db.ReferenceProperty(models.Page, collection_name='sitemaps')
+  entries = db.TextProperty()
+  modified = db.DateTimeProperty(auto_now=True)
+
+  @staticmethod
+  def key_for(number):
+    """Returns the key of the shard with the given number."""
+    return db.Key.from_path('SitemapShard', 'shard-%d' % number)
+
+  def get_start_key(self):
+    """Returns the key of the first page of the shard, without fetching it."""
+    return SitemapShard.start_key.get_value_for_datastore(self)
+
+
+def get_shard_list():
+  """Returns the number and modification time of every shard.
+
+  Returns:
+    A list of (number, modified) tuples ordered by number
+
+  """
+  key = 'sitemap-shards'
+  shards = utility.memcache_get(key)
+  if shards is None:
+    shards = [(shard.number, shard.modified)
+              for shard in SitemapShard.all().order('number')]
+    utility.memcache_set(key, shards)
+  return shards
+
+
+def render_shard(number, host):
+  """Returns the urlset document of a shard.
+
+  Args:
+    number: number of the shard
+    host: scheme and host name prefixed to every path
+
+  Returns:
+    The XML document, or None if there is no such shard
+
+  """
+  shard = SitemapShard.get(SitemapShard.key_for(number))
+  if not shard:
+    return None
+  parts = [SITEMAP_HEADER % 'urlset']
+  for line in (shard.entries or u'').splitlines():
+    path, lastmod = line.split('\t')[-2:]
+    parts.append('<url><loc>%s/%s</loc><lastmod>%s</lastmod></url>\n' % (
+        saxutils.escape(host),
+        saxutils.escape(urllib.quote(path.encode('utf-8'), '/')), lastmod))
+  parts.append('</urlset>\n')
+  return ''.join(parts)
+
+
+def render_index(shards, host):
+  """Returns the sitemapindex document listing every shard.
+
+  Args:
+    shards: list of (number, modified) tuples, as from get_shard_list
+    host: scheme and host name of the site
+
+  Returns:
+    The XML document
+
+  """
+  parts = [SITEMAP_HEADER % 'sitemapindex']
+  for number, modified in shards:
+    parts.append('<sitemap><loc>%s/sitemap-%d.xml</loc>'
+                 '<lastmod>%s</lastmod></sitemap>\n' % (
+                     saxutils.escape(host), number,
+                     modified.strftime('%Y-%m-%d')))
+  parts.append('</sitemapindex>\n')
+  return ''.join(parts)
+
+
+def get_path(page, paths):
+  """Returns the path of a page, remembering the paths of its ancestors.
+
+  Args:
+    page: the Page
+    paths: dict mapping page keys to paths, shared across calls
+
+  """
+  page_key = page.key()
+  if page_key not in paths:
+    parent_key = models.Page.parent_page.get_value_for_datastore(page)
+    if parent_key is None:
+      paths[page_key] = ''
+    else:
+      if parent_key not in paths:
+        get_path(models.Page.get(parent_key), paths)
+      paths[page_key] = '%s%s/' % (paths[parent_key], page.name)
+  return paths[page_key]
+
+
+def shard_entries(pages, paths):
+  """Returns the sitemap entries for a list of pages and their attachments.
+
+  Args:
+    pages: list of Page objects
+    paths: dict mapping page keys to paths, shared across calls
+
+  Returns:
+    A list of 'page_id<TAB>path<TAB>YYYY-MM-DD' strings
+
+  """
+  public_pages = [page for page in pages if page.user_can_read(None)]
+  entries = []
+  for page in public_pages:
+    entries.append(u'%d\t%s\t%s' % (page.key().id(), get_path(page, paths),
+                                     page.modified.strftime('%Y-%m-%d')))
+
+  page_keys = [page.key() for page in public_pages]
+  for start in range(0, len(page_keys), FILE_QUERY_BATCH_SIZE):
+    batch = page_keys[start:start + FILE_QUERY_BATCH_SIZE]
+    query = models.FileStore.all().filter('parent_page IN', batch)
+    for file_record in query:
+      if (file_record.is_hidden or file_record.url_data or
+          not file_record.user_can_read(None)):
+        continue
+      parent_key = models.FileStore.parent_page.get_value_for_datastore(
+          file_record)
+      entries.append(u'%d\t%s%s\t%s' % (
+          parent_key.id(), paths[parent_key], file_record.name,
+          file_record.modified.strftime('%Y-%m-%d')))
+  return entries
+
+
+def store_shard(number, start_key, entries):
+  """Stores the entries of one shard.
+
+  Args:
+    number: number of the shard
+    start_key: key of the first page of the shard, or None for the first
+    entries: list of entries, as from shard_entries
+
+  """
+  SitemapShard(key=SitemapShard.key_for(number), number=number,
+               start_key=start_key, entries=db.Text(u'\n'.join(entries))).put()
+  utility.memcache_delete(['sitemap-shards'])
+
+
+def delete_shards_after(number):
+  """Deletes the shards left over from a larger sitemap."""
+  query = SitemapShard.all(keys_only=True).filter('number >', number)
+  db.delete(list(query))
+  utility.memcache_delete(['sitemap-shards'])
+
+
+def queue_rebuild():
+  """Queues a rebuild of every shard, merged with other recent requests."""
+  utility.add_unique_task('sitemap-all',
+                          utility.task_url('rebuild_sitemap'))
+
+
+def update_page(page_id):
+  """Replaces the entries of a page in its shard after it or a file changed.
+
+  The entries are replaced in a transaction on the shard, so that updates of
+  different pages of the same shard do not undo each other.  A shard stored
+  before entries carried their page id, or one that has grown too large, is
+  left to a rebuild of every shard instead.
+
+  Args:
+    page_id: id of the page
+
+  Returns:
+    The number of the updated shard, or None if there are no shards yet
+
+  """
+  page_key = db.Key.from_path('Page', page_id)
+  shard = SitemapShard.all().filter('start_key <=', page_key).order(
+      '-start_key').get()
+  if shard is None:
+    shard = SitemapShard.get(SitemapShard.key_for(0))
+    if shard is None:
+      return None
+
+  page = models.Page.get(page_key)
+  entries = []
+  if page:
+    entries = shard_entries([page], {})
+  prefix = u'%d\t' % page_id
+
+  def txn():
+    """Replaces the lines of the page in the stored shard.
+
+    Returns:
+      False if every shard should be rebuilt instead, True otherwise
+    """
+    stored = SitemapShard.get(shard.key())
+    lines = (stored.entries or u'').splitlines()
+    page_ids = set([page_id])
+    for line in lines:
+      fields = line.split('\t')
+      if len(fields) < 3:
+        return False
+      page_ids.add(int(fields[0]))
+    if len(page_ids) >= 2 * SHARD_SIZE:
+      return False
+    lines = [line for line in lines if not line.startswith(prefix)]
+    stored.entries = db.Text(u'\n'.join(lines + entries))
+    stored.put()
+    return True
+
+  if db.run_in_transaction(txn):
+    utility.memcache_delete(['sitemap-shards'])
+  else:
+    queue_rebuild()
+  return shard.number
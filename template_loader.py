@@ -0,0 +1,93 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Template loader that keeps compiled templates for the instance lifetime.
+
+Theme templates are addressed as 'themes/<theme>/page.html', so the cache key
+covers both the theme and the template name.  Templates pulled in through
+{% extends %} and {% include %} go through the same loader and are cached as
+well.  On the development server the file's modification time is checked on
+every load so that template edits show up without a restart.
+
+"""
+
+import os
+
+from django.conf import settings
+from django.template import loader
+from django.template.loaders import filesystem
+
+
+# Compiled templates, keyed by (template name, template dirs).
+_templates = {}
+
+
+def get_mtime(path):
+  """Returns the modification time of path, or None if it is unreadable."""
+  try:
+    return os.path.getmtime(path)
+  except OSError:
+    return None
+
+
+class Loader(loader.BaseLoader):
+  """Compiles each template once and reuses it across requests."""
+
+  is_usable = True
+
+  def __init__(self, *args, **kwargs):
+    # pylint: disable-msg=W0142
+    super(Loader, self).__init__(*args, **kwargs)
+    self.source_loader = filesystem.Loader()
+
+  def load_template(self, template_name, template_dirs=None):
+    """Returns the compiled template, compiling it on first use.
+
+    Args:
+      template_name: name of the template, relative to the template dirs
+      template_dirs: optional list of directories overriding TEMPLATE_DIRS
+
+    Returns:
+      A tuple of (compiled template, None)
+
+    Raises:
+      TemplateDoesNotExist: the template could not be found
+
+    """
+    key = (template_name, template_dirs and tuple(template_dirs))
+    cached = _templates.get(key)
+    if cached is not None:
+      template, path, mtime = cached
+      if not settings.DEBUG or get_mtime(path) == mtime:
+        return template, None
+
+    source, path = self.source_loader.load_template_source(template_name,
+                                                           template_dirs)
+    origin = loader.make_origin(path, self.source_loader.load_template_source,
+                                template_name, template_dirs)
+    template = loader.get_template_from_string(source, origin, template_name)
+    _templates[key] = (template, path, get_mtime(path))
+    return template, None
+
+  def load_template_source(self, template_name, template_dirs=None):
+    """Returns the raw template source, as the filesystem loader does."""
+    return self.source_loader.load_template_source(template_name,
+                                                   template_dirs)
+
+  def reset(self):
+    """Drops every compiled template."""
+    _templates.clear()
@@ -20,11 +20,12 @@
 # pylint: disable-msg=C0103,C0301
 
 from django.conf.urls import defaults
+import public_urls
 
 urlpatterns = defaults.patterns(
     'views',
     (r'^admin/$', 'admin.index'),
-    (r'^admin/recent/$', 'admin.recently_modified'),
+    (r'^admin/activity/$', 'admin.activity'),
     (r'^admin/new/(\d*)$', 'admin.new_page'),
     (r'^admin/edit/sidebar/$', 'admin.edit_sidebar'),
     (r'^admin/edit/add_to_sidebar/(\d+)$', 'admin.add_to_sidebar'),
@@ -35,12 +36,17 @@ urlpatterns = defaults.patterns(
     (r'^admin/users/addtogroup/(\d+)/([^\s/]*)$', 'admin.add_to_group'),
     (r'^admin/users/removefromgroup/(\d+)/([^\s/]*)$', 'admin.remove_from_group'),
     (r'^admin/users/editgroup/([\w\-]+)$', 'admin.edit_group'),
+    (r'^admin/users/editmembers/(\d+)$', 'admin.edit_group_members'),
     (r'^admin/users/deletegroup/([\w\-]+)$', 'admin.delete_group'),
     (r'^admin/users/bygroup/([\w\-]*)$', 'admin.view_group'),
     (r'^admin/editacl$', 'admin.edit_acl'),
+    (r'^admin/acl/(\d+)/$', 'admin.get_acl_data'),
+    (r'^admin/acl/(\d+)/groups/$', 'admin.get_group_choices'),
     (r'^admin/bulkeditusers/$', 'admin.bulk_edit_users'),
     (r'^admin/exportusers/$', 'admin.export_users'),
     (r'^admin/edit/(\d+)/$', 'admin.edit_page'),
+    (r'^admin/history/(\d+)/$', 'admin.page_history'),
+    (r'^admin/history/(\d+)/(\d+)/$', 'admin.page_revision'),
     (r'^admin/deletepage/([^\s]+)/$', 'admin.delete_page'),
     (r'^admin/download/([\w\-]+).html$', 'admin.download_page_html'),
     (r'^admin/addfile/$', 'admin.upload_file'),
@@ -49,10 +55,12 @@ urlpatterns = defaults.patterns(
     (r'^admin/help/$', 'admin.get_help'),
     (r'^admin/memcache_info/$', 'admin.display_memcache_info'),
     (r'^admin/memcache_info/flush/$', 'admin.flush_memcache_info'),
+    (r'^admin/maintenance/$', 'admin.maintenance'),
+    (r'^_ah/warmup$', 'tasks.warm_instance'),
     (r'^_treedata/$', 'main.get_tree_data'),
-    (r'^sitemap/$', 'main.page_list'),
-    (r'^(.*)$', 'main.get_url'),
 )
+urlpatterns += public_urls.task_patterns(False)
+urlpatterns += public_urls.public_patterns
 
 handler404 = 'utility.page_not_found'
 handler500 = defaults.handler500
@@ -19,6 +19,9 @@
 
 import functools
 import logging
+import threading
+import time
+import urllib
 import configuration
 
 from django import http
@@ -28,6 +31,30 @@ from google.appengine.api import memcache
 from google.appengine.api import users
 import models
 
+# Seconds over which repeated requests for the same unique task are merged.
+UNIQUE_TASK_DELAY = 60
+
+# Seconds after a memcache flush before the most requested entries are
+# refilled; further flushes within this time share the same refill.
+WARM_CACHE_DELAY = 10
+
+# Seconds a request may hold the lease to rebuild a memcache entry.
+LEASE_TIME = 10
+
+# Seconds other requests wait for the holder of a lease to store the entry
+# before rebuilding it themselves.
+LEASE_WAIT = 1.0
+
+# Seconds between checks for the entry while waiting.
+LEASE_POLL_INTERVAL = 0.05
+
+# Seconds during which only one refresh of a stale entry is queued.
+REFRESH_LOCK_TIME = 60
+
+# Memcache values memoized for the duration of the current request, in the
+# values attribute; None outside of a request.
+_request_memo = threading.local()
+
 
 def respond(request, template, params=None):
   """Helper to render a response.
@@ -54,7 +81,9 @@ def respond(request, template, params=None):
     params['sign_out'] = users.CreateLogoutURL('/')
     params['is_admin'] = users.is_current_user_admin()
   else:
-    params['sign_in'] = users.CreateLoginURL(request.path)
+    query = urllib.urlencode({'continue': request.path.encode('utf-8')})
+    params['sign_in'] = '%s?%s' % (urlresolvers.reverse('views.main.sign_in'),
+                                   query)
 
   if hasattr(request, 'profile') and request.profile is not None:
     profile = request.profile
@@ -124,30 +153,334 @@ def edit_updated_page(page_id, message_id='', tab_name=''):
   return http.HttpResponseRedirect(url)
 
 
-def memcache_get(key):
+def start_request_memo():
+  """Starts memoizing memcache values for a new request."""
+  _request_memo.values = {}
+
+
+def end_request_memo():
+  """Forgets the values memoized for the request that ended."""
+  _request_memo.values = None
+
+
+def clear_request_memo():
+  """Forgets the values memoized so far, when the memcache is flushed."""
+  if get_request_memo():
+    start_request_memo()
+
+
+def get_request_memo():
+  """Returns the dict of memoized values, or None outside of a request."""
+  return getattr(_request_memo, 'values', None)
+
+
+def memcache_get(key, lease=False, memo=False):
   """Gets data from the memcache.
 
   This method is currently in place to avoid having to disable the pylint
   message across the codebase.
 
-  """
-  return memcache.get(key)  # pylint: disable-msg=E1101
+  Entries that are expensive to rebuild and requested by many users at once
+  can be read with a lease.  When such an entry is missing, only the first
+  request gets None and rebuilds it, while the others wait for it to be
+  stored.  The rebuilt entry must be stored with memcache_set and the same
+  lease argument, which releases the lease.
 
+  Entries read many times while serving a request, such as user profiles and
+  access decisions, can be memoized: the value is then kept until the end of
+  the request and later reads do not call the memcache.
 
-def memcache_set(key, val):
+  Args:
+    key: the key to get
+    lease: whether concurrent rebuilds of a missing entry are prevented
+    memo: whether the value is memoized for the rest of the request
+
+  Returns:
+    The stored value, or None if the caller should build it
+
+  """
+  values = None
+  if memo:
+    values = get_request_memo()
+  if values and key in values:
+    return values[key]
+  value = memcache.get(key)  # pylint: disable-msg=E1101
+  if value is None and lease and not acquire_lease(key):
+    value = wait_for_lease(key)
+  if value is not None and values is not None:
+    values[key] = value
+  return value
+
+
+def memcache_set(key, val, ttl=0, lease=False, memo=False):
   """Sets data in the memcache.
 
   This method is currently in place to avoid having to disable the pylint
   message across the codebase.
 
+  Args:
+    key: the key to set
+    val: the value to store
+    ttl: optional number of seconds after which the entry expires
+    lease: whether the entry was read with a lease, which is released
+    memo: whether the value is memoized for the rest of the request
+
+  """
+  values = get_request_memo()
+  if values is not None:
+    if memo:
+      values[key] = val
+    else:
+      values.pop(key, None)
+  result = memcache.set(key, val, ttl)  # pylint: disable-msg=E1101
+  if lease:
+    release_lease(key)
+  return result
+
+
+def lease_key(key):
+  """Returns the memcache key of the lease on a key."""
+  return 'lease:%s' % key
+
+
+def acquire_lease(key):
+  """Takes the lease to rebuild a memcache entry.
+
+  Returns:
+    True if the lease was taken, False if another request holds it
+
+  """
+  # pylint: disable-msg=E1101
+  return memcache.add(lease_key(key), 1, LEASE_TIME)
+
+
+def release_lease(key):
+  """Releases the lease on a memcache entry without storing the entry."""
+  memcache.delete(lease_key(key))  # pylint: disable-msg=E1101
+
+
+def wait_for_lease(key):
+  """Waits for the holder of the lease on a key to store the entry.
+
+  Returns:
+    The stored value, or None if the lease was released or the wait timed out
+    without one being stored
+
+  """
+  deadline = time.time() + LEASE_WAIT
+  while time.time() < deadline:
+    time.sleep(LEASE_POLL_INTERVAL)
+    # pylint: disable-msg=E1101
+    cached = memcache.get_multi([key, lease_key(key)])
+    if key in cached:
+      return cached[key]
+    if lease_key(key) not in cached:
+      return None
+  return None
+
+
+def task_url(name):
+  """Returns the URL of one of the views of views.tasks.
+
+  The task patterns are reversed by name rather than by view, as reversing a
+  view imports its module and the public path must not load views.tasks.
+
+  Args:
+    name: name of the view function
+
+  Returns:
+    The path of the task
+  """
+  return urlresolvers.reverse('task-%s' % name)
+
+
+def add_unique_task(name, url, delay=UNIQUE_TASK_DELAY, **params):
+  """Queues a task, unless the same task was already queued recently.
+
+  Changes made within the same period of delay seconds are handled by a
+  single task, which runs at the end of the period.
+
+  Args:
+    name: name identifying the work the task does
+    url: URL of the task
+    delay: length of the period in seconds
+    params: POST parameters to pass to the task
+
+  """
+  from google.appengine.api import taskqueue  # pylint: disable-msg=W0404
+
+  period = int(time.time() / delay)
+  try:
+    taskqueue.add(name='%s-%d' % (name, period), url=url, params=params,
+                  countdown=delay)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def memcache_get_versioned(key, version_keys, lease=False):
+  """Gets an entry stored with memcache_set_versioned.
+
+  Each entry records the values of its version counters when it was built
+  and may have a soft expiry time.  An entry whose counters have since been
+  incremented by soft_invalidate, or whose soft expiry has passed, is stale:
+  it can still be served while a fresh copy is built in the background.
+
+  Args:
+    key: the key to get
+    version_keys: list of the memcache keys of the entry's version counters
+    lease: whether concurrent rebuilds of a missing entry are prevented, as
+           for memcache_get
+
+  Returns:
+    A (value, fresh, versions) tuple.  value is None if there is no entry,
+    and versions must be passed to memcache_set_versioned when the entry is
+    built again.
+
+  """
+  cached = memcache.get_multi([key] + version_keys)  # pylint: disable-msg=E1101
+  versions = tuple([cached.get(version_key, 0)
+                    for version_key in version_keys])
+  entry = cached.get(key)
+  if entry is None and lease and not acquire_lease(key):
+    entry = wait_for_lease(key)
+  if entry is None:
+    return None, False, versions
+  entry_versions, soft_expiry, value = entry
+  fresh = (entry_versions == versions and
+           (not soft_expiry or time.time() < soft_expiry))
+  return value, fresh, versions
+
+
+def memcache_set_versioned(key, val, versions, soft_ttl=0, lease=False):
+  """Sets an entry read with memcache_get_versioned.
+
+  Args:
+    key: the key to set
+    val: the value to store
+    versions: the versions returned by memcache_get_versioned before the
+              value was built
+    soft_ttl: optional number of seconds after which the entry is stale
+    lease: whether the entry was read with a lease, which is released
+
+  """
+  soft_expiry = soft_ttl and time.time() + soft_ttl or 0
+  return memcache_set(key, (versions, soft_expiry, val), lease=lease)
+
+
+def soft_invalidate(version_key):
+  """Marks the entries depending on a version counter as stale."""
+  memcache_incr(version_key)
+
+
+def refresh_lock_key(key):
+  """Returns the memcache key marking a queued refresh of a key."""
+  return 'refresh:%s' % key
+
+
+def queue_refresh(key, **params):
+  """Queues the task that rebuilds a stale entry, unless already queued.
+
+  The task removes the mark left by this function once the entry is built.
+
+  Args:
+    key: the key of the stale entry
+    params: POST parameters telling views.tasks.refresh_cache what to build
+
+  """
+  from google.appengine.api import taskqueue  # pylint: disable-msg=W0404
+
+  # pylint: disable-msg=E1101
+  if not memcache.add(refresh_lock_key(key), 1, REFRESH_LOCK_TIME):
+    return
+  params['key'] = key
+  try:
+    taskqueue.add(url=task_url('refresh_cache'),
+                  params=params)
+  except taskqueue.Error, err:
+    logging.warning('Could not queue the refresh of %s: %s', key, err)
+    memcache.delete(refresh_lock_key(key))
+
+
+def memcache_get_multi(keys):
+  """Gets a list of keys from the memcache in one call.
+
+  This method is currently in place to avoid having to disable the pylint
+  message across the codebase.
+
+  Returns:
+    A dict of the keys found and their values
+
   """
-  return memcache.set(key, val)  # pylint: disable-msg=E1101
+  return memcache.get_multi(keys)  # pylint: disable-msg=E1101
+
+
+def memcache_set_multi(mapping):
+  """Sets a dict of keys and values in the memcache in one call.
+
+  This method is currently in place to avoid having to disable the pylint
+  message across the codebase.
+
+  """
+  values = get_request_memo()
+  if values:
+    for key in mapping:
+      values.pop(key, None)
+  return memcache.set_multi(mapping)  # pylint: disable-msg=E1101
+
+
+def memcache_incr(key):
+  """Increments a counter in the memcache, creating it if it is missing.
+
+  This method is currently in place to avoid having to disable the pylint
+  message across the codebase.
+
+  Returns:
+    The new value of the counter, or None if the memcache is unavailable
+
+  """
+  return memcache.incr(key, initial_value=0)  # pylint: disable-msg=E1101
+
+
+def memcache_incr_multi(keys):
+  """Increments several counters in the memcache in one call.
+
+  Missing counters are created, as with memcache_incr.
+
+  Returns:
+    A dict mapping each key to its new value, or None for counters that
+    could not be incremented
+
+  """
+  # pylint: disable-msg=E1101
+  return memcache.offset_multi(dict([(key, 1) for key in keys]),
+                               initial_value=0)
+
+
+def memcache_delete(keys):
+  """Deletes a list of keys from the memcache in one call.
+
+  This method is currently in place to avoid having to disable the pylint
+  message across the codebase.
+
+  """
+  values = get_request_memo()
+  if values:
+    for key in keys:
+      values.pop(key, None)
+  return memcache.delete_multi(keys)  # pylint: disable-msg=E1101
 
 
 def clear_memcache():
-  """Flushes the memcache when an entry is edited."""
+  """Flushes the memcache when an entry is edited.
+
+  A task is queued to refill the most requested entries shortly after.
+
+  """
+  clear_request_memo()
   if not memcache.flush_all():  # pylint: disable-msg=E1101
     logging.error('Failed to clear the cache!')
+  add_unique_task('warm-cache', task_url('warm_cache'),
+                  delay=WARM_CACHE_DELAY)
 
 
 def flush_cache(func):
@@ -157,7 +490,7 @@ def flush_cache(func):
   def wrapper(*args, **kwargs):
     data = func(*args, **kwargs)
     logging.info('Flushing the cache')
-    _local_cache.clear()
+    clear_request_memo()
     if not memcache.flush_all():
       logging.error('Memcache flush failed.')
     return data
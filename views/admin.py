@@ -18,6 +18,8 @@
 """Administrative views for page editing and user management."""
 
 import csv
+import datetime
+import difflib
 import functools
 import logging
 import StringIO
@@ -26,14 +28,26 @@ from django import http
 from django.core import urlresolvers
 from django.core import validators
 from django.core import exceptions
+from django.utils import simplejson
 from django.utils import translation
-import forms
 from google.appengine.api import memcache
 from google.appengine.ext import db
 import models
 import utility
 import yaml
 
+# Number of changes listed per page of the activity feed.
+ACTIVITY_PAGE_SIZE = 50
+
+# Number of revisions listed per page of a page's history.
+REVISION_PAGE_SIZE = 50
+
+# Number of groups returned per request by the ACL editor's group pickers.
+GROUP_PAGE_SIZE = 20
+
+# Number of members listed per page when viewing a group.
+GROUP_MEMBERS_PAGE_SIZE = 100
+
 
 def admin_required(func):
   """Ensure that the logged in user is an administrator."""
@@ -74,10 +88,97 @@ def index(request):
 
 
 @super_user_required
-def recently_modified(request):
-  """Show the 10 most recently modified pages."""
-  pages = models.Page.all().order('modified').fetch(10)
-  return utility.respond(request, 'admin/recently_modified', {'pages': pages})
+def activity(request):
+  """Shows recent changes to pages, attachments, ACLs and the sidebar.
+
+  Args:
+    request: The request object, with optional GET parameters 'since', a date
+             formatted as YYYY-MM-DD or YYYY-MM-DD HH:MM, and 'cursor'
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  since = request.GET.get('since', '').strip()
+  since_time = None
+  for date_format in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+    try:
+      since_time = datetime.datetime.strptime(since, date_format)
+      break
+    except ValueError:
+      pass
+
+  activities, cursor = models.Activity.feed(
+      ACTIVITY_PAGE_SIZE, since_time, request.GET.get('cursor'))
+  return utility.respond(request, 'admin/activity',
+                         {'activities': activities, 'cursor': cursor,
+                          'since': since_time and since or ''})
+
+
+def page_history(request, page_id):
+  """Lists the saved revisions of a page.
+
+  Args:
+    request: The request object, with an optional 'cursor' GET parameter
+    page_id: ID of the page
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  page = models.Page.get_by_id(int(page_id))
+  if not page:
+    return utility.page_not_found(request)
+  if not page.user_can_write(request.profile):
+    return utility.forbidden(request)
+
+  query = models.PageRevision.all().ancestor(page).order('-number')
+  cursor = request.GET.get('cursor')
+  if cursor:
+    query.with_cursor(cursor)
+  revisions = query.fetch(REVISION_PAGE_SIZE)
+  cursor = None
+  if len(revisions) == REVISION_PAGE_SIZE:
+    cursor = query.cursor()
+  return utility.respond(request, 'admin/page_history',
+                         {'page': page, 'revisions': revisions,
+                          'cursor': cursor})
+
+
+def page_revision(request, page_id, number):
+  """Shows a revision of a page and its differences from the one before.
+
+  Args:
+    request: The request object
+    page_id: ID of the page
+    number: number of the revision
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  page = models.Page.get_by_id(int(page_id))
+  if not page:
+    return utility.page_not_found(request)
+  if not page.user_can_write(request.profile):
+    return utility.forbidden(request)
+
+  number = int(number)
+  revision, content = models.PageRevision.get_content(page.key(), number)
+  if revision is None:
+    return utility.page_not_found(request)
+  previous_content = u''
+  if number:
+    previous_content = models.PageRevision.get_content(page.key(),
+                                                       number - 1)[1] or u''
+
+  diff = difflib.HtmlDiff(wrapcolumn=80).make_table(
+      previous_content.splitlines(), content.splitlines(),
+      translation.ugettext('Revision %d') % (number - 1),
+      translation.ugettext('Revision %d') % number, context=True)
+  return utility.respond(request, 'admin/page_revision',
+                         {'page': page, 'revision': revision,
+                          'content': content, 'diff': diff})
 
 
 @super_user_required
@@ -151,11 +252,93 @@ def edit_acl(request):
     remove_access(acl, object_list)
 
   acl.put()
+  models.Activity.record(models.ACTIVITY_ACL, models.ACTIVITY_UPDATED,
+                         page.key().id(), name=page.name)
 
   return utility.edit_updated_page(page_id, tab_name='security',
                                  message_id='msgChangesSaved')
 
 
+def get_acl_data(request, page_id):
+  """Returns the groups and users named in a page's ACL as JSON.
+
+  The security tab of the page editor loads this when it is first shown, so
+  opening a page for editing does not read the ACL's groups and users.  The
+  groups and users of all four lists are fetched in a single batch.
+
+  Args:
+    request: The request object
+    page_id: ID of the page
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  page = models.Page.get_by_id(int(page_id))
+  if not page:
+    return utility.page_not_found(request)
+  if not page.user_can_write(request.profile):
+    return utility.forbidden(request)
+
+  acl = page.acl
+  lists = ['group_write', 'group_read', 'user_write', 'user_read']
+  keys = set()
+  for list_name in lists:
+    keys.update(getattr(acl, list_name))
+  keys = list(keys)
+  entities = dict(zip(keys, db.get(keys)))
+
+  data = {'inherits_acl': page.inherits_acl()}
+  if data['inherits_acl']:
+    data['inherits_from'] = '/' + page.inherits_acl_from().path
+  for list_name in lists:
+    data[list_name] = [{'id': key.id(), 'name': str(entities[key])}
+                       for key in getattr(acl, list_name) if entities[key]]
+
+  return http.HttpResponse(simplejson.dumps(data),
+                           mimetype='application/json')
+
+
+def get_group_choices(request, page_id):
+  """Returns one page of groups, optionally matching a name prefix, as JSON.
+
+  Used by the group pickers of the page editor's security tab.  Groups are
+  ordered by name, and the cursor in the response fetches the next page.
+
+  Args:
+    request: The request object, with optional 'prefix' and 'cursor' GET
+             parameters
+    page_id: ID of the page whose ACL is being edited
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  page = models.Page.get_by_id(int(page_id))
+  if not page:
+    return utility.page_not_found(request)
+  if not page.user_can_write(request.profile):
+    return utility.forbidden(request)
+
+  query = models.UserGroup.all().order('name')
+  prefix = request.GET.get('prefix')
+  if prefix:
+    query.filter('name >=', prefix).filter('name <', prefix + u'\ufffd')
+  cursor = request.GET.get('cursor')
+  if cursor:
+    query.with_cursor(cursor)
+  groups = query.fetch(GROUP_PAGE_SIZE)
+
+  data = {'groups': [{'id': group.key().id(), 'name': str(group)}
+                     for group in groups],
+          'cursor': None}
+  if len(groups) == GROUP_PAGE_SIZE:
+    data['cursor'] = query.cursor()
+
+  return http.HttpResponse(simplejson.dumps(data),
+                           mimetype='application/json')
+
+
 def edit_page(request, page_id, parent_id=None):
   """Generates and processes the form to create or edit a specified page.
 
@@ -178,36 +361,15 @@ def edit_page(request, page_id, parent_id=None):
           request, 'No page exists with id %r.' % page_id)
     if not page.user_can_write(request.profile):
       return utility.forbidden(request)
-    files = list(
-        models.FileStore.all().filter('parent_page =', page).order('name'))
-    for item in files:
-      ext = item.name.lower().split('.')[-1]
-      item.icon = '/static/images/fileicons/%s.png' % ext
-
-  acl_data = None
-
-  if page:
-    all_group_keys = [
-        g.key() for g in models.UserGroup.all().order('name')]
-    groups_without_write_keys = [
-        k for k in all_group_keys if k not in page.acl.group_write]
-    groups_without_read_keys = [
-        k for k in all_group_keys if k not in page.acl.group_read]
-    acl_data = {
-        'groups_without_write': models.UserGroup.get(groups_without_write_keys),
-        'groups_without_read': models.UserGroup.get(groups_without_read_keys),
-        'group_write': models.UserGroup.get(page.acl.group_write),
-        'group_read': models.UserGroup.get(page.acl.group_read),
-        'user_write': models.UserProfile.get(page.acl.user_write),
-        'user_read': models.UserProfile.get(page.acl.user_read),
-        'inherits_acl': page.inherits_acl(),
-    }
+    files = page.attached_files()
+
+  import forms  # pylint: disable-msg=W0404
 
   if not request.POST:
     form = forms.PageEditForm(data=None, instance=page)
     return utility.respond(request, 'admin/edit_page',
                            {'form': form, 'page': page, 'files': files,
-                            'acl_data': acl_data, 'parent_id': parent_id})
+                            'parent_id': parent_id})
 
   form = forms.PageEditForm(data=request.POST, instance=page)
 
@@ -287,8 +449,8 @@ def upload_file(request):
   file_name = None
   url = None
   if request.FILES and 'attachment' in request.FILES:
-    file_name = request.FILES['attachment'].name
-    file_data = request.FILES['attachment'].read()
+    file_data = request.FILES['attachment']
+    file_name = file_data.name
   elif 'url' in request.POST:
     url = request.POST['url']
     file_name = url.split('/')[-1]
@@ -311,7 +473,8 @@ def upload_file(request):
     file_record = models.FileStore(name=file_name, parent_page=page)
 
   if file_data:
-    file_record.data = db.Blob(file_data)
+    # Read and stored in chunks, so large uploads are never held in memory.
+    file_record.stage_upload(file_data)
   elif url:
     file_record.url = db.Link(url)
 
@@ -319,7 +482,6 @@ def upload_file(request):
   file_record.is_hidden = 'hidden' in request.POST
 
   file_record.put()
-  utility.clear_memcache()
 
   return utility.edit_updated_page(page_id, tab_name='files')
 
@@ -371,21 +533,9 @@ def filebrowser(request, page_id):
     if not page.user_can_write(request.profile):
       return utility.forbidden(request)
 
-    files = page.attached_files()
-
-    if request.GET.get('Type') == 'Image':
-      files = [item for item in files
-               if item.name.lower().split('.')[-1]
-               in ('jpg', 'gif', 'jpeg', 'png', 'bmp', 'webp')]
-
-    if request.GET.get('Type') == 'Flash':
-      files = [item for item in files
-               if item.name.lower().split('.')[-1]
-               in ('swf', 'flv')]
-
-    for item in files:
-      ext = item.name.lower().split('.')[-1]
-      item.icon = '/static/images/fileicons/%s.png' % ext
+    category = {'Image': models.CATEGORY_IMAGE,
+                'Flash': models.CATEGORY_FLASH}.get(request.GET.get('Type'))
+    files = page.attached_files(category)
 
     return utility.respond(request, 'admin/filebrowser',
                            {'files': files,
@@ -486,13 +636,16 @@ def view_group(request, group_id):
 
   """
   users = models.UserProfile.all().order('email')
+  cursor = None
   if group_id:
     group = models.UserGroup.get_by_id(int(group_id))
-    if group.users:
-      users = models.UserProfile.get(group.users)
-    else:
-      users = []
-  return utility.respond(request, 'admin/view_group', {'users': users})
+    if not group:
+      return utility.page_not_found(request)
+    user_keys, cursor = group.member_keys(GROUP_MEMBERS_PAGE_SIZE,
+                                          request.GET.get('cursor'))
+    users = [user for user in models.UserProfile.get(user_keys) if user]
+  return utility.respond(request, 'admin/view_group',
+                         {'users': users, 'cursor': cursor})
 
 
 @super_user_required
@@ -509,12 +662,7 @@ def add_to_group(_request, group_id, email):
 
   """
   group = models.UserGroup.get_by_id(int(group_id))
-  user_key = models.UserProfile.load(email).key()
-  if group.users is None:
-    group.users = []
-    logging.warning('Group "%s" had a None users list', group.name)
-  group.users.append(user_key)
-  group.put()
+  group.add_user(models.UserProfile.load(email).key())
 
   url = urlresolvers.reverse('views.admin.edit_user', args=[email])
   return http.HttpResponseRedirect(url)
@@ -534,17 +682,40 @@ def remove_from_group(_request, group_id, email):
 
   """
   group = models.UserGroup.get_by_id(int(group_id))
-  user_key = models.UserProfile.load(email).key()
-  if group.users is None:
-    group.users = []
-    logging.warning('Group "%s" had a None users list' % group.name)
-  group.users.remove(user_key)
-  group.put()
+  group.remove_user(models.UserProfile.load(email).key())
 
   url = urlresolvers.reverse('views.admin.edit_user', args=[email])
   return http.HttpResponseRedirect(url)
 
 
+@super_user_required
+def edit_group_members(request, group_id):
+  """Adds and removes lists of users to and from a group.
+
+  Args:
+    request: The request object, with 'add' and 'remove' POST fields holding
+             email addresses separated by whitespace or commas
+    group_id: id of the group to edit
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  group = models.UserGroup.get_by_id(int(group_id))
+  if not group:
+    return utility.page_not_found(request)
+
+  unknown = None
+  if request.POST:
+    add_emails = request.POST.get('add', '').replace(',', ' ').split()
+    remove_emails = request.POST.get('remove', '').replace(',', ' ').split()
+    unknown = group.update_members(add_emails, remove_emails)
+
+  return utility.respond(request, 'admin/edit_group_members',
+                         {'group': group, 'saved': bool(request.POST),
+                          'unknown': unknown})
+
+
 @super_user_required
 def new_group(request):
   """Creates a new group.
@@ -571,6 +742,8 @@ def edit_group(request, group_id):
     A Django HttpResponse object.
 
   """
+  import forms  # pylint: disable-msg=W0404
+
   group = None
   if group_id:
     group = models.UserGroup.get_by_id(int(group_id))
@@ -625,6 +798,8 @@ def edit_user(request, email):
     return utility.page_not_found(request)
   title = translation.ugettext('Edit user: %(email)s') % {'email': email}
 
+  import forms  # pylint: disable-msg=W0404
+
   return utility.edit_instance(request, models.UserProfile, forms.UserEditForm,
                                'admin/edit_user',
                                urlresolvers.reverse('views.admin.index'),
@@ -781,3 +956,29 @@ def display_memcache_info(request):
   # pylint: disable-msg=E1101
   return utility.respond(request, 'admin/memcache_info',
                          {'memcache_info': memcache.get_stats()})
+
+
+@admin_required
+def maintenance(request):
+  """Lists the maintenance tasks and starts the one selected.
+
+  Args:
+    request: The request object
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  from views import tasks  # pylint: disable-msg=W0404
+
+  started = None
+  task_names = [name for name, _ in tasks.MAINTENANCE_TASKS]
+  if request.POST and request.POST.get('task') in task_names:
+    started = request.POST['task']
+    tasks.start_task(started)
+    logging.info('Started maintenance task %s', started)
+
+  task_list = [{'name': name, 'title': title}
+               for name, title in tasks.MAINTENANCE_TASKS]
+  return utility.respond(request, 'admin/maintenance',
+                         {'tasks': task_list, 'started': started})
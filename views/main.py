@@ -19,15 +19,25 @@
 
 import datetime
 import logging
-import mimetypes
 
 import configuration
+import counters
 from django import http
 from django.core import urlresolvers
 from django.utils import simplejson
+from google.appengine.api import users
 import models
+import search
+import sitemap
 import utility
 
+# Number of search results shown per page.
+SEARCH_PAGE_SIZE = 20
+
+# Seconds after which a page rendered for anonymous visitors is rendered again
+# in the background, even if nothing it depends on was saved.
+ANONYMOUS_PAGE_SOFT_TTL = 600
+
 
 def send_page(page, request):
   """Sends a given page to a user if they have access rights.
@@ -50,14 +60,27 @@ def send_page(page, request):
                       (profile.email, page.name))
       return utility.forbidden(request)
 
+  counters.record_view(page.activity_kind, page.key().id())
+  if request.user is None:
+    return send_anonymous_page(page, request)
+  return render_page(page, request)
+
+
+def render_page(page, request):
+  """Renders a page for the user making a request.
+
+  Args:
+    page: The page to render
+    request: The Django request object
+
+  Returns:
+    A Django HttpResponse containing the page.
+
+  """
   files = page.attached_files()
   files = [file_obj for file_obj in files if not file_obj.is_hidden]
 
-  for item in files:
-    ext = item.name.lower().split('.')[-1]
-    item.icon = '/static/images/fileicons/%s.png' % ext
-
-  is_editor = page.user_can_write(profile)
+  is_editor = page.user_can_write(request.profile)
 
   if configuration.SYSTEM_THEME_NAME:
     template = 'themes/%s/page.html' % (configuration.SYSTEM_THEME_NAME)
@@ -66,6 +89,36 @@ def send_page(page, request):
                                              'is_editor': is_editor})
 
 
+def send_anonymous_page(page, request, refresh=False):
+  """Sends a public page to a visitor who is not signed in.
+
+  The rendered page is the same for every such visitor, so it is cached.
+  When the page or the sidebar has been saved since it was rendered, the
+  cached copy is still sent and a task renders the page again.
+
+  Args:
+    page: The page to send, which must be readable by everyone
+    request: The Django request object
+    refresh: whether to render the page even if it is cached
+
+  Returns:
+    A Django HttpResponse containing the page.
+
+  """
+  key = 'anonymous-page:%s' % page.key().id()
+  content, fresh, versions = utility.memcache_get_versioned(
+      key, [page.version_key(), models.SIDEBAR_VERSION_KEY])
+  if content is not None and not refresh:
+    if not fresh:
+      utility.queue_refresh(key, kind='page', item_id=page.key().id())
+    return http.HttpResponse(content)
+
+  response = render_page(page, request)
+  utility.memcache_set_versioned(key, response.content, versions,
+                                 ANONYMOUS_PAGE_SOFT_TTL)
+  return response
+
+
 def send_file(file_record, request):
   """Sends a given file to a user if they have access rights.
 
@@ -78,17 +131,59 @@ def send_file(file_record, request):
 
   """
   profile = request.profile
-  mimetype = mimetypes.guess_type(file_record.name)[0]
+  mimetype = file_record.get_mimetype() or 'application/octet-stream'
 
   if not file_record.user_can_read(profile):
     logging.warning('User %s made an invalid attempt to access file %s' %
                     (profile.email, file_record.name))
     return utility.forbidden(request)
 
+  counters.record_view(file_record.activity_kind, file_record.key().id())
+  variant = request.GET.get('size')
+  if variant:
+    image_variant = file_record.get_variant(variant)
+    if image_variant:
+      versioned = request.GET.get('v') == file_record.data_version
+      return send_image_variant(image_variant, versioned)
+
+  etag = file_record.etag
+  if etag and etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+    response = http.HttpResponseNotModified()
+  else:
+    response = http.HttpResponse(content=file_record.iter_data(),
+                                 mimetype=mimetype)
+
   expires = datetime.datetime.now() + configuration.FILE_CACHE_TIME
-  response = http.HttpResponse(content=file_record.data, mimetype=mimetype)
   response['Cache-Control'] = configuration.FILE_CACHE_CONTROL
   response['Expires'] = expires.strftime('%a, %d %b %Y %H:%M:%S GMT')
+  if etag:
+    response['ETag'] = etag
+  return response
+
+
+def send_image_variant(image_variant, versioned):
+  """Sends a resized image.
+
+  Args:
+    image_variant: The ImageVariant to send
+    versioned: True if the URL carries the current data version, in which case
+               the image is cached for a long time
+
+  Returns:
+    A Django HttpResponse containing the resized image.
+
+  """
+  cache_control = configuration.FILE_CACHE_CONTROL
+  cache_time = configuration.FILE_CACHE_TIME
+  if versioned:
+    cache_control = configuration.IMAGE_VARIANT_CACHE_CONTROL
+    cache_time = configuration.IMAGE_VARIANT_CACHE_TIME
+
+  expires = datetime.datetime.now() + cache_time
+  response = http.HttpResponse(content=image_variant.data,
+                               mimetype=image_variant.mimetype)
+  response['Cache-Control'] = cache_control
+  response['Expires'] = expires.strftime('%a, %d %b %Y %H:%M:%S GMT')
   return response
 
 
@@ -104,32 +199,7 @@ def get_url(request, path_str):
     message.
 
   """
-  def follow_url_forwards(base, path):
-    """Follow the path forwards, returning the desired item."""
-    if not base:
-      return None
-    if not path:
-      utility.memcache_set('path:%s' % path_str, base)
-      return base
-    if len(path) == 1:
-      attachment = base.get_attachment(path[0])
-      if attachment:
-        return attachment
-    return follow_url_forwards(base.get_child(path[0]), path[1:])
-
-  def follow_url_backwards(pre_path, post_path):
-    """Traverse the path backwards to find a cached page or the root."""
-    key = 'path:' + '/'.join(pre_path)
-    item = utility.memcache_get(key)
-    if item:
-      return follow_url_forwards(item, post_path)
-    if not pre_path:
-      return follow_url_forwards(models.Page.get_root(), post_path)
-    return follow_url_backwards(pre_path[:-1], [pre_path[-1]] + post_path)
-
-  path = [dir_name for dir_name in path_str.split('/') if dir_name]
-  item = follow_url_backwards(path, [])
-
+  item = models.File.get_by_path(path_str)
   if isinstance(item, models.Page):
     return send_page(item, request)
 
@@ -176,6 +246,127 @@ def get_tree_data(request):
   return http.HttpResponse(simplejson.dumps(data), mimetype='application/json')
 
 
+def search_pages(request):
+  """Lists the pages matching a search query that the user can read.
+
+  Args:
+    request: The Django request object, with the query in the 'q' GET
+             parameter and the number of matches to skip in 'start'
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  query = request.GET.get('q', '')
+  try:
+    start = max(int(request.GET.get('start', 0)), 0)
+  except ValueError:
+    start = 0
+
+  page_ids = search.search(query)
+  results = []
+  position = start
+  while len(results) < SEARCH_PAGE_SIZE and position < len(page_ids):
+    batch = page_ids[position:position + SEARCH_PAGE_SIZE]
+    for page in models.Page.get_by_id(batch):
+      if len(results) == SEARCH_PAGE_SIZE:
+        break
+      position += 1
+      if page and page.user_can_read(request.profile):
+        results.append(page)
+
+  next_start = None
+  if position < len(page_ids):
+    next_start = position
+  return utility.respond(request, 'search',
+                         {'query': query, 'results': results,
+                          'next_start': next_start})
+
+
+def sitemap_xml(request):
+  """Sends the sitemap, or a sitemap index if it is split into shards.
+
+  Args:
+    request: The Django request object
+
+  Returns:
+    A Django HttpResponse containing the XML document.
+
+  """
+  shards = sitemap.get_shard_list()
+  if not shards:
+    sitemap.queue_rebuild()
+    return http.HttpResponse(status=503)
+  if len(shards) == 1:
+    return sitemap_shard_xml(request, shards[0][0])
+
+  host = 'http://%s' % request.get_host()
+  key = 'sitemap-index:%s:%s' % (host, max([modified for _, modified in
+                                             shards]))
+  content = utility.memcache_get(key)
+  if content is None:
+    content = sitemap.render_index(shards, host)
+    utility.memcache_set(key, content)
+  return send_sitemap(content)
+
+
+def sitemap_shard_xml(request, number):
+  """Sends one shard of the sitemap.
+
+  Args:
+    request: The Django request object
+    number: number of the shard
+
+  Returns:
+    A Django HttpResponse containing the XML document.
+
+  """
+  number = int(number)
+  modified = dict(sitemap.get_shard_list()).get(number)
+  if modified is None:
+    return utility.page_not_found(request)
+
+  host = 'http://%s' % request.get_host()
+  key = 'sitemap:%s:%d:%s' % (host, number, modified)
+  content = utility.memcache_get(key)
+  if content is None:
+    content = sitemap.render_shard(number, host)
+    if content is None:
+      return utility.page_not_found(request)
+    utility.memcache_set(key, content)
+  return send_sitemap(content)
+
+
+def send_sitemap(content):
+  """Returns a response carrying a sitemap document."""
+  expires = datetime.datetime.now() + configuration.SITEMAP_CACHE_TIME
+  response = http.HttpResponse(content=content, mimetype='application/xml')
+  response['Cache-Control'] = configuration.SITEMAP_CACHE_CONTROL
+  response['Expires'] = expires.strftime('%a, %d %b %Y %H:%M:%S GMT')
+  return response
+
+
 def page_list(request):
   """List all pages."""
   return utility.respond(request, 'sitemap')
+
+
+def sign_in(request):
+  """Redirects a visitor to the sign in page.
+
+  Pages rendered for visitors who are not signed in link here instead of to
+  the sign in page itself, whose URL names the host the page was rendered
+  for.  The cached copy of a page is then right for every host of the site,
+  including when it was rendered by a task.
+
+  Args:
+    request: The request object, with the path to return to as 'continue'
+
+  Returns:
+    A Django HttpResponseRedirect object.
+
+  """
+  path = request.GET.get('continue', '/')
+  if not path.startswith('/') or path.startswith('//'):
+    path = '/'
+  return http.HttpResponseRedirect(users.create_login_url(path))
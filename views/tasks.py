@@ -0,0 +1,474 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Views run from the task queue for background and maintenance work.
+
+These views are mapped under /_tasks/, which app.yaml restricts to
+administrators and to the task queue itself.  Long running jobs process one
+batch per request and enqueue themselves with a cursor to continue.
+
+"""
+
+import functools
+import logging
+
+from django import http
+from django.core import urlresolvers
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+import counters
+import models
+from views import main
+import search
+import sitemap
+import utility
+import warmup
+
+# Number of entities processed by each request of a batched task.
+BATCH_SIZE = 100
+
+# Number of files whose data is loaded by each request of a batched task.
+DATA_BATCH_SIZE = 10
+
+# Maintenance tasks that administrators can start, as (view name, title).
+MAINTENANCE_TASKS = (
+    ('backfill_files', 'Store size, type and category of existing files'),
+    ('deduplicate_files', 'Move existing file data to shared storage'),
+    ('index_group_names', 'Index the names of existing groups'),
+    ('index_profile_emails', 'Index the email addresses of existing users'),
+    ('migrate_group_members', 'Move group members to membership entities'),
+    ('rebuild_search_index', 'Add existing pages to the search index'),
+    ('rebuild_sitemap', 'Rebuild the sitemap'),
+)
+
+
+def task_required(func):
+  """Ensure that the request comes from the task queue or an administrator."""
+
+  @functools.wraps(func)
+  def __wrapper(request, *args, **kwds):
+    """Makes it possible for task_required to be used as a decorator."""
+    if ('HTTP_X_APPENGINE_TASKNAME' in request.META or
+        getattr(request, 'user_is_admin', False)):
+      return func(request, *args, **kwds)  # pylint: disable-msg=W0142
+    else:
+      return utility.forbidden(
+          request,
+          error_message='This page can only be run as a task.')
+
+  return __wrapper
+
+
+def start_task(name, **params):
+  """Adds a task for one of the views in this module to the task queue.
+
+  Args:
+    name: name of the view function
+    params: POST parameters to pass to the task
+
+  """
+  taskqueue.add(url=utility.task_url(name), params=params)
+
+
+@task_required
+def backfill_files(request):
+  """Stores the size, mime type, extension and category of existing files.
+
+  Args:
+    request: The request object
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  query = models.FileStore.all()
+  cursor = request.POST.get('cursor')
+  if cursor:
+    query.with_cursor(cursor)
+  # The data of every file in the batch is loaded to measure it.
+  files = query.fetch(DATA_BATCH_SIZE)
+
+  blob_keys = [models.FileStore.blob_data.get_value_for_datastore(item)
+               for item in files]
+  blobs = dict([(blob.key(), blob)
+                for blob in db.get([key for key in blob_keys if key])
+                if blob])
+
+  for item, blob_key in zip(files, blob_keys):
+    item.update_metadata()
+    if blob_key in blobs and blobs[blob_key].data is not None:
+      item.size = len(blobs[blob_key].data)
+
+  # Saved in one batch, bypassing File.put and its cache flush per file.
+  db.put(files)
+
+  if len(files) == DATA_BATCH_SIZE:
+    start_task('backfill_files', cursor=query.cursor())
+  else:
+    logging.info('Finished backfilling file metadata')
+    utility.clear_memcache()
+
+  return http.HttpResponse('Updated %d files' % len(files),
+                           mimetype='text/plain')
+
+
+@task_required
+def deduplicate_files(request):
+  """Moves the data of files stored before content addressing to shared data.
+
+  Args:
+    request: The request object
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  query = models.FileStore.all()
+  cursor = request.POST.get('cursor')
+  if cursor:
+    query.with_cursor(cursor)
+  batch = query.fetch(DATA_BATCH_SIZE)
+  files = [item for item in batch if not item.content_hash and
+           models.FileStore.blob_data.get_value_for_datastore(item)]
+
+  for item in files:
+    old_blob_key = models.FileStore.blob_data.get_value_for_datastore(item)
+    data = item.blob_data.read()
+    item.content_hash = models.FileStoreData.hash_data(data)
+    item.blob_data = models.FileStoreData.acquire(data, item.content_hash)
+    # Saved directly, bypassing File.put and its cache flush per file.
+    db.put(item)
+    models.FileStoreData.release(old_blob_key)
+
+  if len(batch) == DATA_BATCH_SIZE:
+    start_task('deduplicate_files', cursor=query.cursor())
+  else:
+    logging.info('Finished deduplicating file data')
+    utility.clear_memcache()
+
+  return http.HttpResponse('Moved %d files' % len(files),
+                           mimetype='text/plain')
+
+
+@task_required
+def index_group_names(request):
+  """Creates the name claims of groups saved before names were indexed.
+
+  Groups whose name is already claimed by another group are logged and left
+  without a claim, to be renamed by an administrator.
+
+  Args:
+    request: The request object
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  query = models.UserGroup.all()
+  cursor = request.POST.get('cursor')
+  if cursor:
+    query.with_cursor(cursor)
+  groups = query.fetch(BATCH_SIZE)
+
+  name_keys = [models.UserGroupName.key_for(group.name) for group in groups]
+  claims = dict(zip(name_keys, db.get(name_keys)))
+  new_claims = []
+  for group, name_key in zip(groups, name_keys):
+    claim = claims[name_key]
+    if claim is None:
+      claim = models.UserGroupName(key=name_key, group=group)
+      claims[name_key] = claim
+      new_claims.append(claim)
+    elif claim.group_key() != group.key():
+      logging.warning('Group %s has the same name as group %s: "%s"',
+                      group.key().id(), claim.group_key().id(), group.name)
+  db.put(new_claims)
+
+  if len(groups) == BATCH_SIZE:
+    start_task('index_group_names', cursor=query.cursor())
+  else:
+    logging.info('Finished indexing group names')
+
+  return http.HttpResponse('Indexed %d group names' % len(new_claims),
+                           mimetype='text/plain')
+
+
+@task_required
+def index_profile_emails(request):
+  """Creates the UserProfileEmail entities of profiles saved before them.
+
+  Args:
+    request: The request object
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  query = models.UserProfile.all()
+  cursor = request.POST.get('cursor')
+  if cursor:
+    query.with_cursor(cursor)
+  profiles = query.fetch(BATCH_SIZE)
+
+  lookups = []
+  for profile in profiles:
+    lookups.append(models.UserProfileEmail(
+        key=models.UserProfileEmail.key_for(profile.email), profile=profile))
+  db.put(lookups)
+
+  if len(profiles) == BATCH_SIZE:
+    start_task('index_profile_emails', cursor=query.cursor())
+  else:
+    logging.info('Finished indexing profile email addresses')
+
+  return http.HttpResponse('Indexed %d email addresses' % len(profiles),
+                           mimetype='text/plain')
+
+
+@task_required
+def migrate_group_members(request):
+  """Moves the members of groups saved before memberships existed.
+
+  Each request moves at most models.WRITE_BATCH_SIZE members of one group
+  from its users list to GroupMembership entities.  The task continues with
+  the same group until its list is empty, then moves on to the next group.
+
+  Args:
+    request: The request object
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  query = models.UserGroup.all()
+  cursor = request.POST.get('cursor')
+  if cursor:
+    query.with_cursor(cursor)
+  groups = query.fetch(1)
+  if not groups:
+    logging.info('Finished migrating group members')
+    utility.clear_memcache()
+    return http.HttpResponse('Finished migrating group members',
+                             mimetype='text/plain')
+
+  group = groups[0]
+  moved = group.migrate_members()
+  if group.users:
+    start_task('migrate_group_members', cursor=cursor or '')
+  else:
+    start_task('migrate_group_members', cursor=query.cursor())
+
+  return http.HttpResponse('Moved %d members' % moved, mimetype='text/plain')
+
+
+@task_required
+def delete_group_members(request):
+  """Deletes the memberships of a deleted group, one batch per request.
+
+  Args:
+    request: The request object, with the group_id of the deleted group
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  group_id = int(request.POST['group_id'])
+  group_key = db.Key.from_path('UserGroup', group_id)
+  if not models.GroupMembership.delete_batch(group_key):
+    start_task('delete_group_members', group_id=group_id)
+  else:
+    utility.clear_memcache()
+
+  return http.HttpResponse('Deleted members of group %d' % group_id,
+                           mimetype='text/plain')
+
+
+@task_required
+def page_changed(request):
+  """Updates the search index and the sitemap after a page or file changed.
+
+  Args:
+    request: The request object, with the page_id of the page that changed
+             or that the changed file is attached to, and a search flag set
+             if the page itself changed
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  page_id = int(request.POST['page_id'])
+  if request.POST.get('search'):
+    search.update_page(db.Key.from_path('Page', page_id))
+
+  if sitemap.update_page(page_id) is None:
+    sitemap.queue_rebuild()
+
+  return http.HttpResponse('Updated page %d' % page_id,
+                           mimetype='text/plain')
+
+
+@task_required
+def rebuild_search_index(request):
+  """Indexes every existing page.
+
+  Args:
+    request: The request object
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  query = models.Page.all()
+  cursor = request.POST.get('cursor')
+  if cursor:
+    query.with_cursor(cursor)
+  pages = query.fetch(DATA_BATCH_SIZE)
+
+  for page in pages:
+    search.update_page(page.key())
+
+  if len(pages) == DATA_BATCH_SIZE:
+    start_task('rebuild_search_index', cursor=query.cursor())
+  else:
+    logging.info('Finished rebuilding the search index')
+
+  return http.HttpResponse('Indexed %d pages' % len(pages),
+                           mimetype='text/plain')
+
+
+@task_required
+def rebuild_sitemap(request):
+  """Redraws the sitemap shards and rebuilds every one of them.
+
+  Each request builds one shard of sitemap.SHARD_SIZE pages.
+
+  Args:
+    request: The request object
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  number = int(request.POST.get('number', 0))
+  query = models.Page.all().order('__key__')
+  cursor = request.POST.get('cursor')
+  if cursor:
+    query.with_cursor(cursor)
+  pages = query.fetch(sitemap.SHARD_SIZE)
+  if number and not pages:
+    sitemap.delete_shards_after(number - 1)
+    logging.info('Finished rebuilding the sitemap')
+    return http.HttpResponse('Finished rebuilding the sitemap',
+                             mimetype='text/plain')
+
+  start_key = None
+  if number and pages:
+    start_key = pages[0].key()
+  sitemap.store_shard(number, start_key, sitemap.shard_entries(pages, {}))
+
+  if len(pages) == sitemap.SHARD_SIZE:
+    start_task('rebuild_sitemap', number=number + 1, cursor=query.cursor())
+  else:
+    sitemap.delete_shards_after(number)
+    logging.info('Finished rebuilding the sitemap')
+
+  return http.HttpResponse('Built sitemap shard %d' % number,
+                           mimetype='text/plain')
+
+
+@task_required
+def store_view_counts(request):
+  """Adds the view counts flushed by an instance to the stored counts.
+
+  Args:
+    request: The request object, with the counts in the POST data
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  counters.store_counts(request.POST.get('counts', ''),
+                        request.POST['flush_id'],
+                        int(request.POST['day']),
+                        int(request.POST['shard']))
+  return http.HttpResponse('Stored view counts', mimetype='text/plain')
+
+
+@task_required
+def refresh_cache(request):
+  """Renders again a stale entry that is being served from the memcache.
+
+  Args:
+    request: The request object, with the key of the entry and the kind and
+      id of the rendered item in the POST data
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  kind = request.POST.get('kind')
+  item_id = int(request.POST.get('item_id', 0))
+  if kind == 'page':
+    page = models.Page.get_by_id(item_id)
+    if page and page.acl.global_read:
+      # The page is rendered as for an anonymous visitor of its own URL.
+      request.path = urlresolvers.reverse('views.main.get_url',
+                                          args=[page.path])
+      main.send_anonymous_page(page, request, refresh=True)
+  elif kind == 'sidebar':
+    profile = None
+    if item_id:
+      profile = models.UserProfile.get_by_id(item_id)
+    if profile or not item_id:
+      models.Sidebar.render(profile, refresh=True)
+  utility.memcache_delete(
+      [utility.refresh_lock_key(request.POST.get('key', ''))])
+  return http.HttpResponse('Refreshed %s' % request.POST.get('key'),
+                           mimetype='text/plain')
+
+
+@task_required
+def warm_cache(_request):
+  """Refills the memcache after it has been flushed.
+
+  Args:
+    _request: The request object (ignored)
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  warmed = warmup.warm()
+  return http.HttpResponse('Warmed %d items' % warmed, mimetype='text/plain')
+
+
+def warm_instance(_request):
+  """Handles the warm-up request sent to a new instance before it serves.
+
+  The request is sent by App Engine; requests from outside for /_ah/ paths
+  are not routed to the application.  Importing this module has already
+  loaded the views and models.
+
+  Args:
+    _request: The request object (ignored)
+
+  Returns:
+    A Django HttpResponse object.
+
+  """
+  warmed = warmup.warm()
+  return http.HttpResponse('Warmed %d items' % warmed, mimetype='text/plain')
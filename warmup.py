@@ -0,0 +1,73 @@
+#!/usr/bin/python2.5
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Refills the memcache with the most requested entries.
+
+warm rebuilds the root page, the anonymous sidebar and, for the most viewed
+pages and attachments as ranked by counters, the path lookup, the anonymous
+ACL decision, the breadcrumbs and the attachment list.  It stops at a
+deadline, so it can run at the start of a request.  It is run from the
+instance warm-up request and from a task queued whenever the memcache is
+flushed.
+
+"""
+
+import time
+
+import counters
+import models
+
+# Number of pages and of attachments warmed, most viewed first.
+WARMUP_ITEMS = 25
+
+# Seconds warm may run for.
+WARMUP_SECONDS = 5
+
+
+def warm(seconds=WARMUP_SECONDS):
+  """Rebuilds the memcache entries used to serve the most viewed items.
+
+  Args:
+    seconds: time after which no more items are warmed
+
+  Returns:
+    The number of items warmed
+
+  """
+  deadline = time.time() + seconds
+  models.Page.get_root()
+  models.Sidebar.render(None)
+
+  items = models.Page.get_by_id(
+      counters.popular(models.ACTIVITY_PAGE, WARMUP_ITEMS))
+  items += models.FileStore.get_by_id(
+      counters.popular(models.ACTIVITY_FILE, WARMUP_ITEMS))
+  warmed = 0
+  for item in items:
+    if time.time() >= deadline:
+      break
+    if item is None:
+      continue
+    item = models.File.get_by_path(item.path)
+    if item is None:
+      continue
+    item.user_can_read(None)
+    if isinstance(item, models.Page):
+      item.breadcrumbs  # pylint: disable-msg=W0104
+      item.attached_files()
+    warmed += 1
+  return warmed
@@ -17,16 +17,202 @@
 
 """Code to serve files from zip files located in different locations.
 
+The archives are opened once per instance and their member index is kept in
+memory, so a request for a member costs a dictionary lookup and, the first
+time the member is requested, a single decompression.  The decompressed and
+gzipped copies are kept up to MAX_CACHED_BYTES per archive, dropping the
+least recently used first.  Members are served
+with a strong ETag derived from their CRC so that browsers revalidate with a
+cheap 304 instead of downloading the editor again.
+
 """
 
+import cStringIO
+import gzip
+import mimetypes
+import zipfile
+
 from google.appengine.ext import webapp
-from google.appengine.ext import zipserve
 from google.appengine.ext.webapp import util
 
+
+# Members are immutable for a given deployment, so clients may keep them.
+ZIP_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Mime types worth keeping a gzipped copy of.
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript',
+                      'application/x-javascript', 'application/json',
+                      'application/xml')
+
+# Members smaller than this are not worth compressing.
+MIN_COMPRESS_SIZE = 512
+
+# Largest number of bytes of member copies kept in memory per archive.
+MAX_CACHED_BYTES = 8 * 1024 * 1024
+
+# Parsed archives, keyed by file name.
+_archives = {}
+
+
+class MemberCache(object):
+  """Keeps copies of members up to a total size, least recently used first."""
+
+  def __init__(self, max_bytes):
+    """Creates an empty cache.
+
+    Args:
+      max_bytes: largest total size of the copies kept
+
+    """
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.clock = 0
+    self.entries = {}
+
+  def get(self, key):
+    """Returns the copy stored under key, or None if it is not cached."""
+    entry = self.entries.get(key)
+    if entry is None:
+      return None
+    self.clock += 1
+    entry[1] = self.clock
+    return entry[0]
+
+  def put(self, key, content):
+    """Stores a copy, dropping the least recently used ones to make room."""
+    if len(content) > self.max_bytes:
+      return
+    if key in self.entries:
+      self.size -= len(self.entries.pop(key)[0])
+    self.clock += 1
+    self.entries[key] = [content, self.clock]
+    self.size += len(content)
+    while self.size > self.max_bytes:
+      oldest = min(self.entries, key=lambda name: self.entries[name][1])
+      self.size -= len(self.entries.pop(oldest)[0])
+
+
+class ZipArchive(object):
+  """An opened zip file with an in-memory index of its members."""
+
+  def __init__(self, filename):
+    """Opens the archive and indexes its members.
+
+    Args:
+      filename: path of the zip file, relative to the application root
+
+    """
+    self.zip_file = zipfile.ZipFile(filename)
+    self.members = {}
+    for info in self.zip_file.infolist():
+      if not info.filename.endswith('/'):
+        self.members[info.filename] = info
+    self.cache = MemberCache(MAX_CACHED_BYTES)
+
+  def get_info(self, name):
+    """Returns the ZipInfo for the member, or None if it does not exist."""
+    return self.members.get(name)
+
+  def read(self, name):
+    """Returns the uncompressed content of a member, through the cache."""
+    content = self.cache.get(('plain', name))
+    if content is None:
+      content = self.zip_file.read(name)
+      self.cache.put(('plain', name), content)
+    return content
+
+  def read_gzipped(self, name):
+    """Returns a gzip encoded copy of a member, through the cache."""
+    content = self.cache.get(('gzip', name))
+    if content is None:
+      buf = cStringIO.StringIO()
+      gzip_file = gzip.GzipFile(mode='wb', fileobj=buf, compresslevel=9)
+      gzip_file.write(self.read(name))
+      gzip_file.close()
+      content = buf.getvalue()
+      self.cache.put(('gzip', name), content)
+    return content
+
+
+def get_archive(filename):
+  """Returns the ZipArchive for filename, opening it on first use."""
+  archive = _archives.get(filename)
+  if archive is None:
+    archive = ZipArchive(filename)
+    _archives[filename] = archive
+  return archive
+
+
+def is_compressible(mimetype, size):
+  """Determines if a member should be served gzip encoded.
+
+  Args:
+    mimetype: mime type of the member
+    size: uncompressed size of the member
+
+  Returns:
+    True if a compressed copy of the member should be kept
+
+  """
+  return size >= MIN_COMPRESS_SIZE and mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def make_zip_handler(filename):
+  """Creates a RequestHandler class serving the members of a zip file.
+
+  Args:
+    filename: path of the zip file, relative to the application root
+
+  Returns:
+    A webapp.RequestHandler subclass
+
+  """
+
+  class ZipHandler(webapp.RequestHandler):
+    """Serves members of a single zip file."""
+
+    def get(self, name):
+      """Sends the named member, or a 304 if the client copy is current."""
+      archive = get_archive(filename)
+      info = archive.get_info(name)
+      if info is None:
+        self.error(404)
+        return
+
+      etag = '"%08x-%x"' % (info.CRC & 0xffffffff, info.file_size)
+      mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+      headers = self.response.headers
+      headers['ETag'] = etag
+      headers['Cache-Control'] = ZIP_CACHE_CONTROL
+      headers['Vary'] = 'Accept-Encoding'
+
+      if_none_match = self.request.headers.get('If-None-Match', '')
+      if etag in [tag.strip() for tag in if_none_match.split(',')]:
+        self.response.set_status(304)
+        return
+
+      headers['Content-Type'] = mimetype
+      accept_encoding = self.request.headers.get('Accept-Encoding', '')
+      if ('gzip' in accept_encoding and
+          is_compressible(mimetype, info.file_size)):
+        headers['Content-Encoding'] = 'gzip'
+        self.response.out.write(archive.read_gzipped(name))
+      else:
+        self.response.out.write(archive.read(name))
+
+    def head(self, name):
+      """Answers HEAD requests like GET, without a body."""
+      self.get(name)
+      self.response.clear()
+
+  return ZipHandler
+
+
 def main():
   """Sets up handlers for the zip files."""
-  ck_editor = zipserve.make_zip_handler('third_party/ckeditor.zip')
-  
+  ck_editor = make_zip_handler('third_party/ckeditor.zip')
+
   application = webapp.WSGIApplication(
       [('/ckeditor/(.*)', ck_editor),
       ])